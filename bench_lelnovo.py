@@ -0,0 +1,305 @@
+import argparse
+import json
+import math
+import random
+import re
+import time
+import sys
+import os
+
+import lelnovo
+import snapshots
+from scrape_lenovo import get_changes
+
+# approximate part count of a scraped region today
+BASE_PARTS = 1500
+
+BRANDS = {
+    'thinkpadx1':     ('ThinkPad X1',    ['Carbon', 'Yoga', 'Extreme', 'Nano', 'Titanium']),
+    'thinkpadt':      ('ThinkPad T',     ['T14', 'T14s', 'T15', 'T15p', 'T16']),
+    'thinkpadp':      ('ThinkPad P',     ['P1', 'P14s', 'P15', 'P15v', 'P17']),
+    'thinkpadl':      ('ThinkPad L',     ['L13', 'L14', 'L15']),
+    'thinkpade':      ('ThinkPad E',     ['E14', 'E15', 'E16']),
+    'thinkbook':      ('ThinkBook',      ['13s', '14', '15', '16p']),
+    'ideapad-5':      ('IdeaPad 5',      ['Slim 5', 'Flex 5', 'Pro 5']),
+    'legion-laptops': ('Legion',         ['5', '5 Pro', '7', 'Slim 7']),
+    'yoga-slim':      ('Yoga Slim',      ['7', '7 Pro', '7 Carbon']),
+}
+PROCESSORS = [
+    ('Intel Core i5-1135G7 Processor (2.40 GHz, up to 4.20 GHz with Turbo Boost, 4 Cores, 8 Threads, 8 MB Cache)', 4),
+    ('Intel Core i7-1165G7 Processor (2.80 GHz, up to 4.70 GHz with Turbo Boost, 4 Cores, 8 Threads, 12 MB Cache)', 4),
+    ('11th Generation Intel Core i7-11800H Processor (2.30 GHz, up to 4.60 GHz with Turbo Boost, 8 Cores, 16 Threads, 24 MB Cache)', 8),
+    ('AMD Ryzen 5 5600U Processor (2.30 GHz, up to 4.20 GHz Max Boost, 6 Cores, 12 Threads, 16 MB Cache)', 6),
+    ('AMD Ryzen 7 PRO 5850U Processor (1.90 GHz, up to 4.40 GHz Max Boost, 8 Cores, 16 Threads, 16 MB Cache)', 8),
+    ('AMD Ryzen 9 5900HX Processor (3.30 GHz, up to 4.60 GHz Max Boost, 8 Cores, 16 Threads, 16 MB Cache)', 8),
+]
+GRAPHICS = [
+    'Integrated Intel Iris Xe Graphics',
+    'Integrated AMD Radeon Graphics',
+    'NVIDIA GeForce MX450 2GB GDDR6',
+    'NVIDIA GeForce RTX 3060 6GB GDDR6',
+    'NVIDIA RTX A2000 4GB GDDR6',
+]
+DISPLAYS = [
+    ('14.0" FHD (1920 x 1080) IPS, anti-glare, 300 nits', 14.0, 1920, 1080),
+    ('14.0" WUXGA (1920 x 1200) IPS, anti-glare, touch, 400 nits', 14.0, 1920, 1200),
+    ('14.0" UHD (3840 x 2400) IPS, anti-reflective, 500 nits', 14.0, 3840, 2400),
+    ('15.6" FHD (1920 x 1080) IPS, anti-glare, 250 nits', 15.6, 1920, 1080),
+    ('16.0" WQXGA (2560 x 1600) IPS, anti-glare, 165Hz', 16.0, 2560, 1600),
+    ('13.3" 2.8K (2880 x 1800) OLED, glossy, touch', 13.3, 2880, 1800),
+]
+OPERATING_SYSTEMS = ['Windows 10 Home 64', 'Windows 10 Pro 64', 'Windows 11 Home 64', 'Windows 11 Pro 64', 'No Operating System']
+MEMORIES = [8, 16, 32, 64]
+STORAGES = [256, 512, 1024, 2048]
+STATUSES = ['Add to cart', 'Add to cart', 'Add to cart', 'customize', 'Unavailable']
+
+# representative query mix for search benchmarks
+QUERIES = {
+    'generic': [
+        'x1',
+        'carbon',
+        'thinkpad',
+        'i7',
+        'oled',
+    ],
+    'spec': [
+        'processor:ryzen',
+        'cpu:i7-11800h',
+        'display:wqxga',
+        'os:pro',
+        'product:x1',
+    ],
+    'num_spec': [
+        'price<=1400',
+        'memory>=16',
+        'price<1000, memory>=16',
+        'ppi>200, weight<1.5',
+        'storage>=1024, display size>=15',
+    ],
+    'prefix': [
+        'pn:20*',
+        'pn:82j*',
+        'product:thint1*',
+        'pn:20*, price<1000',
+    ],
+    'mixed': [
+        'x1, price<=1400, display:fhd',
+        'ryzen, memory>=16, price<1200',
+        'thinkpad, os:pro, storage>=512, sort:price, limit:10',
+        '~thinkapd, cpu:i7, price<2000',
+        'legion | p15, !graphics:mx450, memory>=32',
+    ],
+}
+
+# returns synthetic db with the schema written by scrape_lenovo.py
+def generate_db(parts=BASE_PARTS, seed=0, region='us/en', region_short='us', timestamp=None):
+    r = random.Random(seed)
+
+    db = {
+        'metadata': {
+            'region':       region,
+            'short region': region_short,
+            'base url':     f'https://www.lenovo.com/{region}',
+        },
+        'changes': {},
+        'prices': {},
+        'keys': {
+            'info': [],
+            'num_specs': [],
+        },
+        'brands': {},
+        'data': {},
+    }
+
+    # spread parts over product lines of every brand, scaling product line count with parts
+    prods_per_model = max(1, round(parts/BASE_PARTS*2))
+    prods = []
+    for brand, (brand_name, models) in BRANDS.items():
+        db['brands'][brand] = []
+        db['data'][brand] = {}
+        for model in models:
+            for gen in range(prods_per_model):
+                prodn = f'{brand[:4].upper()}{re.sub(r"[^A-Z0-9]", "", model.upper())}G{gen+1}'
+                db['brands'][brand].append([prodn, f'{brand_name} {model} Gen {gen+1} ({r.choice(["Intel", "AMD"])})'])
+                db['data'][brand][prodn] = []
+                prods.append((brand, prodn, f'{brand_name} {model} Gen {gen+1}'))
+
+    info_keys = set()
+    num_spec_keys = set()
+    pns = set()
+    while len(pns) < parts:
+        brand, prodn, prod_name = r.choice(prods)
+        pn = f'{r.choice(["20", "21", "82"])}{r.choice("ABCDEFGHJKLMNPRSTUVWXYZ")}{r.choice("0123456789ABCDEFGHJK")}{r.randint(0, 999):03d}{r.choice(["US", "CA", "UK"])}'
+        if pn in pns: continue
+        pns.add(pn)
+
+        processor, cores = r.choice(PROCESSORS)
+        display, size, hres, vres = r.choice(DISPLAYS)
+        memory = r.choice(MEMORIES)
+        storage = r.choice(STORAGES)
+        weight = round(r.uniform(0.9, 2.8), 2)
+        price = round(r.uniform(450, 4500), 2)
+        part = {
+            'part number':      pn,
+            'name':             f'{prod_name} {r.choice(["Intel", "AMD"])} ({size}") - {r.choice(["Black", "Grey", "Storm Grey"])}',
+            'status':           r.choice(STATUSES),
+            'shipping':         f'Ships in {r.randint(1, 20)} business days',
+            'processor':        processor,
+            'operating system': r.choice(OPERATING_SYSTEMS),
+            'graphics':         r.choice(GRAPHICS),
+            'memory':           f'{memory}GB DDR4 3200MHz',
+            'storage':          f'{storage}GB SSD M.2 2280 PCIe Gen4 TLC Opal',
+            'display':          display,
+            'wireless':         r.choice(['Intel Wi-Fi 6 AX201 2x2 AX & Bluetooth 5.1', 'Intel Wi-Fi 6E AX210 2x2 AX & Bluetooth 5.2']),
+            'battery':          f'{r.choice([3, 4])} Cell Li-Polymer {r.choice([51, 57, 80])}Wh',
+            'ac adapter':       f'{r.choice([45, 65, 135, 230])}W USB-C',
+            'color':            r.choice(['Black', 'Storm Grey', 'Arctic Grey']),
+            'weight':           f'{weight} kg',
+            'camera':           r.choice(['720p HD', '1080p FHD', '1080p FHD IR Hybrid']),
+            'security chip':    'Discrete TPM 2.0, TCG Certified',
+            'summary':          f'{prod_name} with {processor}, {memory}GB memory and {storage}GB storage',
+            'num_specs': {
+                'price':                  [price, '$'],
+                'memory':                 [float(memory), 'GB'],
+                'storage':                [storage, 'GB'],
+                'cpu cores':              [cores, ''],
+                'display size':           [size, 'in'],
+                'display res horizontal': [hres, 'px'],
+                'display res vertical':   [vres, 'px'],
+                'pixel density':          [int(round(math.sqrt(hres**2+vres**2)/size)), 'ppi'],
+                'weight':                 [weight, 'kg'],
+            },
+        }
+        if r.random() < 0.3: part['coupon'] = r.choice(['THINKPADSALE', 'EXTRA5'])
+        if r.random() < 0.5: part['fp reader'] = 'Fingerprint Reader'
+
+        db['data'][brand][prodn].append(part)
+        db['prices'][pn] = part['num_specs']['price']
+        info_keys.update(part.keys())
+        num_spec_keys.update(part['num_specs'].keys())
+
+    info_keys.remove('num_specs')
+    db['keys']['info'] = list(info_keys)
+    db['keys']['num_specs'] = list(num_spec_keys)
+    db['metadata']['total'] = parts
+    db['metadata']['timestamp'] = timestamp if timestamp is not None else 1640995200.0
+    return db
+
+# returns next scrape of db with some parts added, removed, and repriced
+def generate_snapshot(db, seed=0, days=1, change_ratio=0.05):
+    r = random.Random(seed)
+    new_db = json.loads(json.dumps({k: v for k, v in db.items() if k != 'index'}))
+    new_db['metadata']['timestamp'] = db['metadata']['timestamp'] + days*86400
+
+    parts = [(brand, prodn, part) for brand, prods in new_db['data'].items() for prodn, ps in prods.items() for part in ps]
+    for brand, prodn, part in r.sample(parts, int(len(parts)*change_ratio)):
+        choice = r.random()
+        if choice < 0.2:
+            new_db['data'][brand][prodn].remove(part)
+            del new_db['prices'][part['part number']]
+        else:
+            price = round(part['num_specs']['price'][0]*r.uniform(0.8, 1.15), 2)
+            part['num_specs']['price'] = [price, '$']
+            new_db['prices'][part['part number']] = part['num_specs']['price']
+    new_db['metadata']['total'] = len(new_db['prices'])
+    new_db['changes'] = get_changes(new_db, db)
+    return new_db
+
+# returns (mean, p50, p95) seconds of fn over repeat runs
+def time_fn(fn, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter()-start)
+    times = sorted(times)
+    return (
+        sum(times)/len(times),
+        times[len(times)//2],
+        times[min(len(times)-1, int(len(times)*0.95))],
+    )
+
+def format_row(cols, widths):
+    return '  '.join([f'{str(c):{w}}' if i == 0 else f'{str(c):>{w}}' for i, (c, w) in enumerate(zip(cols, widths))])
+
+def run(scales, repeat, snaps, seed):
+    lines = []
+    def out(line=''):
+        print(line)
+        lines.append(line)
+
+    widths = [52, 8, 10, 10, 10, 10]
+    header = ['benchmark', 'results', 'mean ms', 'p50 ms', 'p95 ms', 'ops/s']
+
+    for scale in scales:
+        parts = int(BASE_PARTS*scale)
+        start = time.perf_counter()
+        db = generate_db(parts, seed=seed)
+        db['index'] = lelnovo.build_index(db)
+        out(f'## {scale}x ({parts} parts, index built in {(time.perf_counter()-start)*1000:.0f}ms incl. generation)')
+        out(format_row(header, widths))
+        out('-'*(sum(widths)+2*(len(widths)-1)))
+
+        with open(os.devnull, 'w') as devnull:
+            stdout = sys.stdout
+            sys.stdout = devnull # silence ignored query terms
+            rows = []
+            for kind, queries in QUERIES.items():
+                for query in queries:
+                    results, error = lelnovo.search(query, db)
+                    rows.append([f'search {kind:8} {query}', len(results), *time_fn(lambda: lelnovo.search(query, db), repeat)])
+            sys.stdout = stdout
+
+        pns = list(db['prices'].keys())
+        r = random.Random(seed)
+        sample = [r.choice(pns) for i in range(repeat)]
+        it = iter(sample*2)
+        rows.append(['get_specs', '', *time_fn(lambda: lelnovo.get_specs(next(it), db), repeat)])
+        it = iter(sample*2)
+        rows.append(['get_specs with specs', '', *time_fn(lambda: lelnovo.get_specs(next(it), db, ['cpu', 'ram', 'price']), repeat)])
+        it = iter(sample*2)
+        rows.append(['complete (4 char prefix)', '', *time_fn(lambda: lelnovo.complete(next(it)[:4], {'us': db}), repeat)])
+
+        dbs = [db]
+        for i in range(snaps):
+            dbs.append(generate_snapshot(dbs[-1], seed=seed+i+1))
+        it = iter(sample*2)
+        rows.append([f'get_history ({len(dbs)} snapshots)', '', *time_fn(lambda: lelnovo.get_history(next(it), dbs), repeat)])
+        rows.append([f'get_histories (4 parts, {len(dbs)} snapshots)', '', *time_fn(lambda: lelnovo.get_histories(r.sample(pns, 4), dbs), repeat)])
+        history = lelnovo.build_history('us', [lelnovo.price_snapshot(db) for db in dbs])
+        it = iter(sample*2)
+        rows.append([f'get_history_data ({len(dbs)} snapshot matrix)', '', *time_fn(lambda: lelnovo.get_history_data(history, next(it)), repeat)])
+        rows.append(['get_deals (top 50)', '', *time_fn(lambda: lelnovo.get_deals(dbs[-1], history, max_results=50), repeat)])
+        rows.append(['get_movers (7 days, top 50)', '', *time_fn(lambda: lelnovo.get_movers(dbs[-1], history, 7, max_results=50), repeat)])
+        rows.append(['add_history_snapshot', '', *time_fn(lambda: lelnovo.add_history_prices(history, history['ts'][-1]+1, lelnovo.price_snapshot(dbs[-1])[1]), repeat)])
+        rows.append(['format_changes', '', *time_fn(lambda: lelnovo.format_changes(dbs[-1]['changes'], db['metadata']['base url']), repeat)])
+
+        for row in rows:
+            name, results, mean, p50, p95 = row
+            out(format_row([name[:widths[0]], results, f'{mean*1000:.3f}', f'{p50*1000:.3f}', f'{p95*1000:.3f}', f'{1/mean:.0f}'], widths))
+        out()
+    return lines
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark lelnovo search and history functions on synthetic databases')
+    parser.add_argument('-s', '--scales', type=float, nargs='+', default=[1, 10], help='part count multipliers of a region today')
+    parser.add_argument('-r', '--repeat', type=int, default=20, help='runs per benchmark')
+    parser.add_argument('-n', '--snapshots', type=int, default=30, help='history snapshots')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='also write results table to file')
+    parser.add_argument('-g', '--generate', metavar='DIR', help='only write synthetic db and history snapshots to DIR')
+    args = parser.parse_args()
+
+    if args.generate:
+        if not os.path.exists(f'{args.generate}/backup'): os.makedirs(f'{args.generate}/backup')
+        db = generate_db(int(BASE_PARTS*args.scales[0]), seed=args.seed)
+        for i in range(args.snapshots):
+            snapshots.write_snapshot(f'{args.generate}/backup', db)
+            db = generate_snapshot(db, seed=args.seed+i+1)
+        with open(f'{args.generate}/db_us.json', 'w') as f: json.dump(db, f)
+        print(f'Wrote \'{args.generate}/db_us.json\' and {args.snapshots} backups to \'{args.generate}/backup\'')
+    else:
+        lines = run(args.scales, args.repeat, args.snapshots, args.seed)
+        if args.output:
+            with open(args.output, 'w') as f: f.write('\n'.join(lines)+'\n')
+            print(f'Wrote results to \'{args.output}\'')
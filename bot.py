@@ -1,13 +1,21 @@
 import lelnovo
+import pricedb
+import snapshots
 
 import re
+import io
+import asyncio
 import configparser
 import json, time
 import os
 import atexit
+import multiprocessing
 import sys
 import requests
+import numpy as np
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
@@ -32,11 +40,17 @@ else:
     CFG.set('bot', 'embed_color', 'e41c1c')
     CFG.set('bot', 'db_dir', '')
     CFG.set('bot', 'backup_dir', '')
+    CFG.set('bot', 'history_db', '')
+    CFG.set('bot', 'plot_cache_dir', '')
     with open(CFG_FILENAME, 'w') as cfg_file: CFG.write(cfg_file)
     sys.exit(f'Created template \'{CFG_FILENAME}\'. Add bot token and restart.')
 
 DB_DIR = CFG['bot']['db_dir']
 BACKUP_DIR = CFG['bot']['backup_dir']
+# price history store written by scrape_lenovo.py --history_db, backup dir is read per request without it
+HISTORY_DB = pricedb.connect(CFG['bot']['history_db']) if CFG['bot'].get('history_db') else None
+# history plots evicted from memory are spilled to a subdirectory of plot_cache_dir if set
+if CFG['bot'].get('plot_cache_dir'): lelnovo.init_plot_cache(CFG['bot']['plot_cache_dir'])
 BOT_PREFIXES = []
 for prefix in CFG['bot']['prefixes'].split(','):
     BOT_PREFIXES.append(prefix.strip())
@@ -53,6 +67,7 @@ CMD_ALIASES = {
     'st': 'status',
     'sr': 'setregion',
     'ps': 'psref',
+    'a':  'all',
 }
 REGCMD_ALIASES = {
     'st': 'status',
@@ -61,6 +76,10 @@ REGCMD_ALIASES = {
     's':  'search',
     'sp': 'specs',
     'hi': 'history',
+    'cp': 'compare',
+    'ex': 'explain',
+    'dl': 'deals',
+    'mv': 'movers',
 }
 
 BOT = discord.ext.commands.Bot(
@@ -69,6 +88,21 @@ BOT = discord.ext.commands.Bot(
 )
 
 DBS = {} # { short_region: db, ... }
+HISTORIES = {} # { short_region: lelnovo price history matrix, ... }
+BACKUP_CATALOG = None # snapshots catalog of BACKUP_DIR, kept current by BackupFileHandler
+STARTED = False # on_ready() fires again on reconnect, observers and histories are only set up once
+SEARCH_MAX_RESULTS = 100 # max search results rendered into embeds
+DEALS_MAX_RESULTS = 50 # max deals rendered into embeds
+MOVERS_MAX_RESULTS = 50 # max changed parts rendered into embeds
+MOVERS_MAX_LINES = 10 # max changed product lines rendered into embeds
+# history plots are rendered off the event loop in worker processes
+# workers are forked once in __main__, before watchdog threads exist
+PLOT_WORKERS = 2
+def new_plot_pool():
+    return ProcessPoolExecutor(max_workers=PLOT_WORKERS, mp_context=multiprocessing.get_context('fork'))
+PLOT_POOL = new_plot_pool()
+PLOT_SEMAPHORE = asyncio.Semaphore(PLOT_WORKERS) # one slot per worker, held until its render finishes
+PLOT_TIMEOUT = 20 # seconds
 
 class FileHandler(FileSystemEventHandler):
     def on_modified(self, event):
@@ -78,12 +112,67 @@ class FileHandler(FileSystemEventHandler):
             for i in range(5):
                 try:
                     DBS = lelnovo.get_dbs(DB_DIR)
+                    for region, db in DBS.items():
+                        if region in HISTORIES: lelnovo.add_history_snapshot(HISTORIES[region], db)
                     print('\n'.join([lelnovo.get_footer(db) for db in DBS.values()]))
+                    print(f'Search cache: {lelnovo.get_search_cache_stats()}')
+                    print(f'Plot cache: {lelnovo.get_plot_cache_stats()}')
                     break
                 except json.decoder.JSONDecodeError:
                     print(f'JSON load error. Retrying ({i+1}/5)...')
                     time.sleep(1)
 
+class BackupFileHandler(FileSystemEventHandler):
+    def on_created(self, event):
+        snapshots.update_catalog(BACKUP_CATALOG, event.src_path)
+
+    def on_deleted(self, event):
+        snapshots.update_catalog(BACKUP_CATALOG, event.src_path)
+
+    # snapshots are written to a temp file and moved into place
+    def on_moved(self, event):
+        snapshots.update_catalog(BACKUP_CATALOG, event.src_path)
+        self.add_snapshot(event.dest_path)
+
+    def on_modified(self, event):
+        self.add_snapshot(event.src_path)
+
+    def add_snapshot(self, path):
+        if snapshots.update_catalog(BACKUP_CATALOG, path):
+            for i in range(5):
+                try:
+                    db = snapshots.load_snapshot(path)
+                    region = db['metadata']['short region']
+                    # only new snapshot is appended, known timestamps are skipped
+                    if region in HISTORIES and lelnovo.add_history_snapshot(HISTORIES[region], db):
+                        print(f'Added \'{path}\' to {region} price history')
+                    break
+                except json.decoder.JSONDecodeError:
+                    print(f'JSON load error. Retrying ({i+1}/5)...')
+                    time.sleep(1)
+
+# price history matrix per region from history store or backup dir and current db
+def load_histories():
+    histories = {}
+    for region, db in DBS.items():
+        start = time.time()
+        if HISTORY_DB: snaps = pricedb.get_price_snapshots(HISTORY_DB, region)
+        else:          snaps = lelnovo.get_backup_price_snapshots(BACKUP_DIR, region)
+        snaps.append(lelnovo.price_snapshot(db))
+        histories[region] = lelnovo.build_history(region, snaps)
+        print(f'Loaded {region} price history ({len(histories[region]["rows"])} parts x {len(histories[region]["ts"])} snapshots) in {time.time()-start:.1f}s')
+    return histories
+
+# db updates and backups that land while histories load are skipped by the file handlers
+# adds current dbs and backups changed since load start, known timestamps are skipped
+def catch_up_histories(since):
+    for region, db in DBS.items():
+        if region in HISTORIES: lelnovo.add_history_snapshot(HISTORIES[region], db)
+    if BACKUP_CATALOG:
+        for entry in snapshots.catalog_snapshots(BACKUP_CATALOG):
+            if entry['mtime'] >= since and entry['region'] in HISTORIES:
+                lelnovo.add_history_snapshot(HISTORIES[entry['region']], snapshots.load_snapshot(entry['path']))
+
 ### start command for every region ###
 
 @BOT.command()
@@ -159,7 +248,7 @@ async def cmd_status(context):
         region = db['metadata']['short region']
         if not (guild_id in DISABLED_REGIONS and region in DISABLED_REGIONS[guild_id]):
             contents = ''
-            contents += lelnovo.get_status(db, BACKUP_DIR)
+            contents += lelnovo.get_status(db, BACKUP_CATALOG)
 
             footer = lelnovo.get_footer(db)
             # remove divider line
@@ -240,14 +329,60 @@ async def cmd_psref(context, *args):
 
     await try_send(context, embed=embed)
 
+@BOT.command(name='all',
+    aliases=['a'],
+)
+async def cmd_all(context, *args):
+    guild_id = context.guild.id
+    cmd = REGCMD_ALIASES[args[0]] if args and args[0] in REGCMD_ALIASES else (args[0] if args else '')
+    params = ' '.join(args[1:]).strip(',')
+
+    if cmd == 'search' and params:
+        dbs = {}
+        for region, db in DBS.items():
+            if not (guild_id in DISABLED_REGIONS and region in DISABLED_REGIONS[guild_id]):
+                dbs[region] = db
+        # search regions concurrently off the event loop
+        region_results = await BOT.loop.run_in_executor(None, lelnovo.search_all, params, dbs, SEARCH_MAX_RESULTS)
+
+        contents = ''
+        found = 0
+        for region, (results, total, error) in region_results.items():
+            base_url = dbs[region]['metadata']['base url']
+            contents += f'\n{lelnovo.get_region_emoji(region)} **{region}**'
+            if error:
+                contents += f' Invalid query\n'
+                continue
+            contents += f' Found **{total}** result{"s" if total!=1 else ""}'
+            if total > len(results): contents += f' (listing first **{len(results)}**)'
+            contents += '\n'
+            for prod, part, matches in results:
+                contents += f'{lelnovo.part_listentry(part, base_url=base_url)}\n'
+            found += total
+
+        embed = discord.Embed(
+            title = f'Search Results for `{params}` in all regions' if found else f'No search results for `{params}` in all regions',
+            description = contents,
+            color=EMBED_COLOR,
+        )
+        embed.set_footer(text = f'Found {found} result{"s" if found!=1 else ""} across {len(dbs)} regions')
+        await try_send_paginated(context, embed)
+    else:
+        await try_send(context, content='```\n'+''.join(lelnovo.get_command_descr('all', BOT_PREFIXES))+'```')
+
 @BOT.event
 async def on_ready():
     global DBS
     global S
+    global BACKUP_CATALOG
+    global STARTED
 
     print('Logged in as {0}'.format(BOT.user.name))
     await BOT.change_presence(activity=discord.Game(f'{BOT_PREFIXES[0]} help'))
 
+    if STARTED: return
+    STARTED = True
+
     S = requests.Session()
     S.headers.update({'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/93.0.4577.82 Safari/537.36'})
 
@@ -261,6 +396,17 @@ async def on_ready():
 
     print('\n'.join([lelnovo.get_footer(db) for db in DBS.values()]))
 
+    if BACKUP_DIR:
+        # catalog is kept current from the moment it is scanned
+        BACKUP_CATALOG = snapshots.new_catalog(BACKUP_DIR)
+        observer.schedule(BackupFileHandler(), path=BACKUP_DIR)
+        print(f'Monitoring \'{BACKUP_DIR}\'')
+    # decoding every backup takes a while, commands fall back to backup dir until loaded
+    if HISTORY_DB or BACKUP_DIR:
+        start = time.time()
+        HISTORIES.update(await BOT.loop.run_in_executor(None, load_histories))
+        await BOT.loop.run_in_executor(None, catch_up_histories, start)
+
 # also handles region-less commands with saved user region
 @BOT.event
 async def on_command_error(context, error):
@@ -310,18 +456,19 @@ async def choose_send(context, args, region):
         region_emoji = lelnovo.get_region_emoji(region)
 
         # send loading message before parsing history cmd
-        # since plot generation can take a while
-        if cmd == 'history' and params:
+        # since plot generation can take a while, cached plots are sent directly
+        pns, text = history_params(params)
+        if cmd == 'history' and pns and not (text or plots_busy() or lelnovo.has_cached_plot(history_plot_key(region, ','.join(pns)))):
             embed = discord.Embed(
                 title=f'{lelnovo.get_region_emoji(region)} Loading price history...',
                 color=EMBED_COLOR,
             )
             embed.set_footer(text=lelnovo.get_footer(db))
             msg = await context.send(embed=embed)
-            content, embed, attach = parse_reg_command(cmd, params, region)
+            content, embed, attach = await parse_reg_command(cmd, params, region)
             await msg.delete()
         else:
-            content, embed, attach = parse_reg_command(cmd, params, region)
+            content, embed, attach = await parse_reg_command(cmd, params, region)
 
         if any([content, embed, attach]):
             if attach: await try_send(context, content=content, embed=embed, file=attach)
@@ -418,7 +565,88 @@ async def try_send_paginated(context, embed, content=None, limit=2048):
     except discord.errors.Forbidden:
         print(f'No permission to send to server \'{context.guild}\': \'#{context.channel}\'')
 
-def parse_reg_command(command, params, region):
+# history plot cache key, changes when a newer snapshot is added to region's history
+def history_plot_key(region, pn):
+    if region in HISTORIES and len(HISTORIES[region]['ts']): ts = float(HISTORIES[region]['ts'][-1])
+    else:                                                   ts = DBS[region]['metadata']['timestamp']
+    return lelnovo.plot_cache_key(region, pn, ts)
+
+# returns ([part number, ...], text mode) of history command params
+def history_params(params):
+    pns = [p.strip(',') for p in params if p not in ['-t', '--text'] and p.strip(',')]
+    return pns, any([p in ['-t', '--text'] for p in params])
+
+# all plot renders in flight, history falls back to text
+def plots_busy():
+    return PLOT_SEMAPHORE.locked()
+
+# returns (dates, prices, parts) like lelnovo.get_histories(), missing prices are -100 or nan
+def get_region_histories(region, pns):
+    db = DBS[region]
+    found = [lelnovo.find_part(pn, db) for pn in pns]
+    if region in HISTORIES and all(found):
+        ts, prices = lelnovo.get_history_rows(HISTORIES[region], [f[2]['part number'] for f in found])
+        return [datetime.utcfromtimestamp(t) for t in ts.tolist()], prices, [f[2] for f in found]
+    # discontinued parts
+    elif HISTORY_DB:
+        histories = [pricedb.get_history(HISTORY_DB, region, pn) for pn in pns]
+        dates = next(([d[0] for d in data] for data, part in histories if part), [])
+        prices = np.array([[d[1] for d in data] if part else [-100]*len(dates) for data, part in histories], dtype=np.float64)
+        return dates, prices.reshape(len(pns), len(dates)), [part for data, part in histories]
+    else:
+        # collect backup dbs for region
+        dbs = [db] + [snapshots.load_snapshot(entry['path']) for entry in snapshots.catalog_snapshots(BACKUP_CATALOG, region)]
+        dbs = sorted(dbs, key=lambda db: db['metadata']['timestamp'])
+        return lelnovo.get_histories(pns, dbs)
+
+# returns [(dt:datetime, price:float, unavailable:bool) ...] like lelnovo.get_history() of one prices row
+def history_data(dates, row):
+    return [(dt, round(price, 2) if price > 0 else -100, False) for dt, price in zip(dates, row)]
+
+def release_plot_slot(future):
+    PLOT_SEMAPHORE.release()
+    # retrieve errors of abandoned renders, awaited renders raise them in render_plot()
+    if not future.cancelled(): future.exception()
+
+# replaces PLOT_POOL if it is still the broken pool (a worker died, e.g. killed for memory)
+# the new workers are forked while other threads run, unlike the first pool forked in __main__
+def reset_plot_pool(broken):
+    global PLOT_POOL
+    if PLOT_POOL is broken:
+        print('Plot pool broken, starting new plot workers')
+        PLOT_POOL = new_plot_pool()
+        broken.shutdown(wait=False)
+
+# returns cached or newly rendered plot png of render(*args) in PLOT_POOL
+# None if rendering timed out or failed twice because plot workers died
+# a timed out render keeps its slot until the worker is done, so abandoned renders can't queue up
+async def render_plot(key, render, *args):
+    png = lelnovo.get_cached_plot(key)
+    if png is not None: return png
+    for attempt in range(2):
+        await PLOT_SEMAPHORE.acquire()
+        pool = PLOT_POOL
+        try:
+            future = BOT.loop.run_in_executor(pool, render, *args)
+        except BrokenProcessPool:
+            PLOT_SEMAPHORE.release()
+            reset_plot_pool(pool)
+            continue
+        future.add_done_callback(release_plot_slot)
+        try:
+            png = await asyncio.wait_for(asyncio.shield(future), PLOT_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f'Rendering plot {key} timed out after {PLOT_TIMEOUT}s')
+            return None
+        except BrokenProcessPool:
+            print(f'Plot worker died rendering {key}')
+            reset_plot_pool(pool)
+            continue
+        lelnovo.put_cached_plot(key, png)
+        return png
+    return None
+
+async def parse_reg_command(command, params, region):
     content = None
     embed = None
     attach = None
@@ -429,7 +657,7 @@ def parse_reg_command(command, params, region):
     if command == 'status':
         embed = discord.Embed(
             title='Database Status',
-            description=lelnovo.get_status(db, BACKUP_DIR),
+            description=lelnovo.get_status(db, BACKUP_CATALOG),
             color=EMBED_COLOR,
         )
         embed.set_footer(text = lelnovo.get_footer(db))
@@ -523,7 +751,7 @@ def parse_reg_command(command, params, region):
         if params:
             summary = ''
 
-            results, error = lelnovo.search(params, db)
+            results, total, error = lelnovo.cached_search(params, db, max_results=SEARCH_MAX_RESULTS)
             if error:
                 embed = discord.Embed(
                     title = f'{region_emoji} Search Failed',
@@ -560,7 +788,7 @@ def parse_reg_command(command, params, region):
                     contents += f'\n {lelnovo.part_listentry(result[1], show_pn=False, show_price=False, fmt="*")}\n'
 
                     added = [] # keep track of added spec matches to avoid duplicates
-                    spacing = max([len(k[0]) for k in spec_matches])
+                    spacing = max([len(k[0]) for k in spec_matches], default=0)
                     for match in result[2]:
                         if match[0] not in added:
                             spec, value = match
@@ -573,7 +801,8 @@ def parse_reg_command(command, params, region):
                         inline = False,
                     )
 
-                summary = f'Found **{len(results)}** result{"s" if len(results)!=1 else ""} for `{params}`'
+                summary = f'Found **{total}** result{"s" if total!=1 else ""} for `{params}`'
+                if total > len(results): summary += f'. Listing first **{len(results)}** (refine with `sort:` and `limit:`)'
                 embed.add_field(
                     name = '\u200b',
                     value = summary,
@@ -581,6 +810,19 @@ def parse_reg_command(command, params, region):
             embed.set_footer(text = lelnovo.get_footer(db))
         else:
             content = '```\n'+''.join(lelnovo.get_command_descr('reg_search', BOT_PREFIXES))+'```'
+    elif command == 'explain':
+        params = ' '.join(params).strip(',')
+        if params:
+            results, error, report = lelnovo.search_explain(params, db)
+            embed = discord.Embed(
+                title = f'{region_emoji} Search plan for `{params}`',
+                description = '```\n'+lelnovo.format_explain(report)+'```',
+                color=EMBED_COLOR,
+            )
+            if error: embed.description += f'\nInvalid query `{params}` (check commas!)'
+            embed.set_footer(text = lelnovo.get_footer(db))
+        else:
+            content = '```\n'+''.join(lelnovo.get_command_descr('reg_explain', BOT_PREFIXES))+'```'
     elif command == 'specs':
         params = ' '.join(params)
         if params:
@@ -608,35 +850,172 @@ def parse_reg_command(command, params, region):
             embed.set_footer(text = lelnovo.get_footer(db))
         else:
             content = '```\n'+''.join(lelnovo.get_command_descr('reg_specs', BOT_PREFIXES))+'```'
+    elif command == 'deals':
+        params = ' '.join(params).strip(',')
+        if region not in HISTORIES:
+            embed = discord.Embed(
+                title = f'{region_emoji} No price history for region `{region}`',
+                color=EMBED_COLOR,
+            )
+        else:
+            deals, total, error = await BOT.loop.run_in_executor(None, lelnovo.get_deals, db, HISTORIES[region], params, DEALS_MAX_RESULTS)
+            query_str = f' for `{params}`' if params else ''
+            if error:
+                embed = discord.Embed(
+                    title = f'{region_emoji} Deals Failed',
+                    description = f'Invalid query `{params}` (check commas!)',
+                    color=EMBED_COLOR,
+                )
+            elif not deals:
+                embed = discord.Embed(
+                    title = f'{region_emoji} No deals{query_str}',
+                    color=EMBED_COLOR,
+                )
+            else:
+                contents = ''
+                for prod, part, price, low, low_ts, high in deals:
+                    pn   = part['part number']
+                    unit = part['num_specs']['price'][1]
+                    low_dt = datetime.utcfromtimestamp(low_ts)
+                    contents += f'**{part["name"]}**\n'
+                    contents += f'{pn} ([link]({db["metadata"]["base url"]}/p/{pn})) **{unit}{price:.2f}** '
+                    contents += f'(-{(1-price/high)*100:.0f}% from {unit}{high:.2f}, '
+                    contents += f'low {unit}{low:.2f} on {low_dt.strftime("%b %d %Y")})\n'
+                contents += f'\nFound **{total}** deal{"s" if total!=1 else ""}{query_str}'
+                if total > len(deals): contents += f'. Listing first **{len(deals)}** (refine with a query)'
+                embed = discord.Embed(
+                    title = f'{region_emoji} Deals{query_str}',
+                    description = contents,
+                    color=EMBED_COLOR,
+                )
+        embed.set_footer(text = lelnovo.get_footer(db))
+    elif command == 'movers':
+        days = lelnovo.parse_window(params[0]) if params else None
+        if days: params = params[1:]
+        else:    days = lelnovo.MOVERS_WINDOW_DAYS
+        params = ' '.join(params).strip(',')
+        if region not in HISTORIES:
+            embed = discord.Embed(
+                title = f'{region_emoji} No price history for region `{region}`',
+                color=EMBED_COLOR,
+            )
+        else:
+            movers, error = await BOT.loop.run_in_executor(None, lelnovo.get_movers, db, HISTORIES[region], days, params, MOVERS_MAX_RESULTS)
+            query_str = f' for `{params}`' if params else ''
+            if error:
+                embed = discord.Embed(
+                    title = f'{region_emoji} Movers Failed',
+                    description = f'Invalid query `{params}` (check commas!)',
+                    color=EMBED_COLOR,
+                )
+            elif not movers['parts']:
+                embed = discord.Embed(
+                    title = f'{region_emoji} No price changes in the last {days} day{"s" if days!=1 else ""}{query_str}',
+                    color=EMBED_COLOR,
+                )
+            else:
+                since_dt = datetime.utcfromtimestamp(movers['since'])
+                contents = f'**Product lines**\n'
+                for prod, changed, count, change in movers['lines'][:MOVERS_MAX_LINES]:
+                    contents += f'`{prod:14}` **{change:+.1f}%** avg ({changed}/{count} products changed)\n'
+                contents += f'\n**Products**\n'
+                for prod, part, old, price, change in movers['parts']:
+                    pn   = part['part number']
+                    unit = part['num_specs']['price'][1]
+                    contents += f'**{part["name"]}**\n'
+                    contents += f'{pn} ([link]({db["metadata"]["base url"]}/p/{pn})) **{change:+.1f}%** {unit}{old:.2f} → **{unit}{price:.2f}**\n'
+                contents += f'\nFound **{movers["total"]}** price change{"s" if movers["total"]!=1 else ""}{query_str} since {since_dt.strftime("%b %d %Y")}'
+                if movers['total'] > len(movers['parts']): contents += f'. Listing largest **{len(movers["parts"])}** (refine with a query)'
+                embed = discord.Embed(
+                    title = f'{region_emoji} Price movers of the last {days} day{"s" if days!=1 else ""}{query_str}',
+                    description = contents,
+                    color=EMBED_COLOR,
+                )
+        embed.set_footer(text = lelnovo.get_footer(db))
+    elif command == 'compare':
+        # leading part numbers (separated by spaces or commas) are resolved in one lookup
+        # specs start after the last part number found, so a typo doesn't swallow the following part numbers
+        # and multi-word specs are kept whole
+        param_str = ' '.join(params)
+        tokens = list(re.finditer(r'[^,\s]+', param_str))
+        parts, missing = lelnovo.get_parts([t.group() for t in tokens], db)
+        found = [i for i, t in enumerate(tokens) if t.group() not in missing]
+        part_nums = [t.group() for t in tokens[:found[-1]+1]] if found else []
+        missing = [pn for pn in part_nums if pn in missing]
+        spec_params = param_str[tokens[found[-1]].end():] if found else param_str
+        specs = [s.strip() for s in spec_params.split(',') if s.strip()]
+
+        if parts:
+            rows, unknown = lelnovo.compare_specs(parts, specs)
+            contents = ''
+            if missing: contents += f'Part numbers not found: `{", ".join(missing)}`\n'
+            if unknown: contents += f'Specs not found: `{", ".join(unknown)}`\n'
+            if rows: contents += lelnovo.format_compare(parts, rows)
+            else:    contents += f'`[no valid specs to list]`\n'
+            embed = discord.Embed(
+                title=f'{region_emoji} Comparing {", ".join([p["part number"] for p in parts])}',
+                description=contents,
+                color=EMBED_COLOR,
+            )
+        elif params:
+            embed = discord.Embed(
+                title=f'{region_emoji} Specs for `{params[0].strip(",")}` not found',
+                description=f'Check that the part number is valid. Discontinued or upcoming products are not in database.',
+                color=EMBED_COLOR,
+            )
+        else:
+            content = '```\n'+''.join(lelnovo.get_command_descr('reg_compare', BOT_PREFIXES))+'```'
+        if embed: embed.set_footer(text = lelnovo.get_footer(db))
     elif command == 'history':
-        if params:
-            if BACKUP_DIR:
-                pn = ''.join(params)
-                # collect backup dbs for region
-                dbs = [db]
-                for f in os.scandir(BACKUP_DIR):
-                    if f.name.startswith(f'db_{region}_') and f.name.endswith('.json'):
-                        with open(f.path, 'r') as f:
-                            js = f.read()
-                            dbs.append(json.loads(js))
-                dbs = sorted(dbs, key=lambda db: db['metadata']['timestamp'])
-
-                data, part = lelnovo.get_history(pn, dbs)
-                if part:
-                    bytes = lelnovo.plot_history(data, part)
-                    bytes.seek(0)
-                    attach = discord.File(bytes, filename='plot.png')
-
+        pns, text = history_params(params)
+        if pns:
+            if HISTORY_DB or BACKUP_DIR:
+                key = history_plot_key(region, ','.join(pns))
+                dates, prices, parts = await BOT.loop.run_in_executor(None, get_region_histories, region, pns)
+                found = [i for i in range(len(pns)) if parts[i]]
+                missing = [pns[i] for i in range(len(pns)) if not parts[i]]
+                prices = prices[found]
+                parts = [parts[i] for i in found]
+                histories = [history_data(dates, row) for row in prices.tolist()]
+                # parts without any recorded price (e.g. listed after histories loaded) are not plotted
+                recorded = [i for i, data in enumerate(histories) if any([d[1] > 0 for d in data])]
+                unrecorded = [parts[i]['part number'] for i in range(len(parts)) if i not in recorded]
+                prices, parts, histories = prices[recorded], [parts[i] for i in recorded], [histories[i] for i in recorded]
+                png = None
+                if parts and not text:
+                    # text summary instead of waiting for a render slot
+                    if plots_busy() and not lelnovo.has_cached_plot(key): text = True
+                    # single part keeps its detailed plot with price labels
+                    elif len(parts) == 1: png = await render_plot(key, lelnovo.plot_history_png, histories[0], parts[0])
+                    else:                 png = await render_plot(key, lelnovo.plot_histories_png, dates, prices, parts)
+
+                if parts:
+                    contents = '\n'.join([lelnovo.part_listentry(part, base_url=db['metadata']['base url']) for part in parts])+'\n'
+                    if missing: contents += f'Not found: `{", ".join(missing)}`\n'
+                    if unrecorded: contents += f'No price history yet: `{", ".join(unrecorded)}`\n'
+                    if png:
+                        attach = discord.File(io.BytesIO(png), filename='plot.png')
+                    # requested text mode, or fallback if plot timed out or too many plots in flight
+                    else:
+                        for part, data in zip(parts, histories):
+                            if len(parts) > 1: contents += f'\n**{part["part number"]}**\n'
+                            contents += f'```\n{lelnovo.format_history_text(data, part)}```'
+                    embed = discord.Embed(
+                        title=f'{region_emoji} Price history for {parts[0]["name"] if len(parts) == 1 else f"{len(parts)} parts"}',
+                        description=contents,
+                        color=EMBED_COLOR,
+                    )
+                    if png: embed.set_image(url='attachment://plot.png')
+                elif unrecorded:
                     embed = discord.Embed(
-                        title=f'{region_emoji} Price history for {part["name"]}',
-                        description=lelnovo.part_listentry(part, base_url=db['metadata']['base url']),
+                        title=f'{region_emoji} No price history for `{", ".join(unrecorded)}` yet',
+                        description=f'Prices are recorded with every database update.',
                         color=EMBED_COLOR,
                     )
-                    embed.set_image(url='attachment://plot.png')
                 else:
                     embed = discord.Embed(
-                        title=f'{region_emoji} Price history for `{pn}` not found',
-                        description=f'Check that the part number is valid. Discontinued or upcoming products are not in database.',
+                        title=f'{region_emoji} Price history for `{" ".join(pns)}` not found',
+                        description=f'Check that the part numbers are valid. Discontinued or upcoming products are not in database.',
                         color=EMBED_COLOR,
                     )
             else:
@@ -665,6 +1044,8 @@ def format_regions(guild_id):
     return contents
 
 if __name__ == '__main__':
+    # fork plot workers now, forking after threads are started can deadlock the workers
+    PLOT_POOL.submit(int).result()
     token = CFG['bot']['discord_token']
     if token: BOT.run(token)
     else:     sys.exit(f'Token not found in \'{CFG_FILENAME}\'')
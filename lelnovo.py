@@ -7,13 +7,22 @@ import operator
 import math
 import textwrap
 import os
+import functools
+import itertools
+import heapq
+import bisect
+import threading
 from datetime import datetime,timezone,timedelta
+from collections import namedtuple, OrderedDict
 from bs4 import BeautifulSoup
 from pprint import pprint
 
+import snapshots
+
 import io
 import numpy as np
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import matplotlib.dates as mdates
 from dateutil.rrule import DAILY
 
@@ -32,6 +41,208 @@ def pretty_duration(time_diff_secs):
     shown_num = int(number)
     return '{} {}'.format(shown_num, unit + ('' if shown_num == 1 else 's'))
 
+def pretty_size(num_bytes):
+    size = float(num_bytes)
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024: break
+        size /= 1024
+    return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+
+# normalized query text is used as the query plan cache key
+def normalize_query(query):
+    return ','.join([term.strip() for term in query.lower().split(',')])
+
+# splits query into terms and boolean operators
+# ',' (and), '|' (or), '!'/'-' (not) and '(' are only operators at the start of a term
+# so parentheses inside terms such as 'display:(1920' are kept
+# leading operators not followed by a term, such as a lone '-', are kept as a literal term
+def tokenize_query(query):
+    tokens = []
+    term = ''
+    raw  = '' # current term including leading operators
+    ops  = 0  # leading operator tokens of current term
+    depth = 0 # unclosed parentheses inside current term
+
+    def end_term():
+        if term.strip():
+            tokens.append(('term', term.strip()))
+        elif ops:
+            del tokens[-ops:]
+            tokens.append(('term', raw.strip()))
+
+    for ch in query:
+        if not term.strip() and ch in '(!-':
+            tokens.append('(' if ch == '(' else '!')
+            ops += 1
+            raw += ch
+            term = ''
+        elif ch in ',|' or (ch == ')' and not depth):
+            end_term()
+            tokens.append(ch)
+            term = ''
+            raw  = ''
+            ops  = 0
+            depth = 0
+        else:
+            if ch == '(': depth += 1
+            if ch == ')': depth -= 1
+            term += ch
+            raw  += ch
+    end_term()
+    return tokens
+
+# compiles normalized query into reusable plan
+# takes info and num_spec key sets of db index since spec validity depends on db
+#plan = QueryPlan(
+#    qs = [ # terms not under '!', listed in results
+#        ('search', term),
+#        ('spec', spec, term),
+#        ('num_spec', spec, op, num),
+#        ('fuzzy', term),
+#        ...
+#    ],
+#    ignored = ['message', ...],
+#    sort    = ('num_spec', descending) or None,
+#    limit   = int or None,
+#    expr    = ('and'|'or', [node, ...]) or ('not', node) or term, None if plain 'and' of qs
+#)
+@functools.lru_cache(maxsize=256)
+def compile_query(query, info_keys, num_spec_keys):
+    ignored = []
+    opts = {'sort': None, 'limit': None}
+    tokens = tokenize_query(query)
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    # returns node, or None if node has no terms
+    def parse_bool(op, sep, parse_operand):
+        nonlocal pos
+        nodes = [parse_operand()]
+        while peek() == sep:
+            pos += 1
+            nodes.append(parse_operand())
+        nodes = [node for node in nodes if node is not None]
+        if not nodes:       return None
+        if len(nodes) == 1: return nodes[0]
+        return (op, nodes)
+
+    def parse_and():
+        return parse_bool('and', ',', parse_or)
+
+    def parse_or():
+        return parse_bool('or', '|', parse_unary)
+
+    def parse_unary():
+        nonlocal pos
+        token = peek()
+        if token == '!':
+            pos += 1
+            node = parse_unary()
+            return ('not', node) if node is not None else None
+        if token == '(':
+            pos += 1
+            node = parse_and()
+            if peek() == ')': pos += 1
+            return node
+        if type(token) == tuple:
+            pos += 1
+            return compile_term(token[1], info_keys, num_spec_keys, opts, ignored)
+        # empty term
+        return compile_term('', info_keys, num_spec_keys, opts, ignored)
+
+    nodes = [parse_and()]
+    while pos < len(tokens):
+        ignored.append(f'Ignoring unmatched \')\' in \'{query}\'')
+        pos += 1
+        if peek() == ',': pos += 1
+        nodes.append(parse_and())
+    nodes = [node for node in nodes if node is not None]
+    expr = ('and', nodes) if len(nodes) > 1 else (nodes[0] if nodes else None)
+
+    # flatten nested 'and's
+    if expr and expr[0] == 'and':
+        children = []
+        for node in expr[1]:
+            children.extend(node[1] if node[0] == 'and' else [node])
+        expr = ('and', children)
+
+    qs = tuple(expr_terms(expr)) if expr else ()
+    # relevance ranks generic terms, without any every part would score 0 and be dropped
+    if opts['sort'] and opts['sort'][0] == 'relevance' and not any([q[0] == 'search' for q in qs]):
+        ignored.append(f'Ignoring sort:relevance without generic search terms in \'{query}\', listing in db order')
+        opts['sort'] = None
+    if expr is None:
+        return QueryPlan((), tuple(ignored), opts['sort'], opts['limit'], None)
+    # plain 'and' of terms is evaluated by query_ords()
+    if expr[0] not in ['and', 'or', 'not'] or (expr[0] == 'and' and all([node[0] not in ['and', 'or', 'not'] for node in expr[1]])):
+        expr = None
+    return QueryPlan(qs, tuple(ignored), opts['sort'], opts['limit'], expr)
+
+# returns term node for single query term, or None if term is invalid or sets sort/limit opts
+def compile_term(term, info_keys, num_spec_keys, opts, ignored):
+    m = re.match(r'(.*?):(.*)', term) # spec:'string' search
+    if m:
+        spec   = m.group(1).strip()
+        search = m.group(2).strip()
+
+        if spec == 'sort': # sort:[-]num_spec result ordering
+            num_spec = search.lstrip('-').strip()
+            if num_spec in NUM_SPEC_ALIASES: num_spec = NUM_SPEC_ALIASES[num_spec]
+            if num_spec in ['relevance', 'rel']:
+                opts['sort'] = ('relevance', True)
+            elif num_spec in num_spec_keys:
+                opts['sort'] = (num_spec, search.startswith('-'))
+            else:
+                ignored.append(f'Ignoring invalid sort num_spec \'{num_spec}\' in \'{term}\'')
+        elif spec == 'limit': # limit:num result count
+            if search.isdigit() and int(search) > 0:
+                opts['limit'] = int(search)
+            else:
+                ignored.append(f'Ignoring invalid limit \'{search}\' in \'{term}\'')
+        elif search.endswith('*') and (spec if spec in info_keys else SPEC_ALIASES.get(spec)) in PREFIX_SPECS:
+            # spec:prefix* lookup in sorted part numbers or product line codes
+            if spec not in info_keys: spec = SPEC_ALIASES[spec]
+            return ('prefix', spec, search[:-1].strip())
+        elif spec in info_keys:
+            return ('spec', spec, search)
+        elif spec in SPEC_ALIASES:
+            return ('spec', SPEC_ALIASES[spec], search)
+        else:
+            ignored.append(f'Ignoring invalid spec \'{spec}\' in \'{term}\'')
+    else:
+        m = re.match(r'\s?([\w ]+)([=<>]+)\s?(.*)', term) # num_spec comparison search
+        if m:
+            spec =   m.group(1).strip()
+            op_str = m.group(2).strip()
+            num    = m.group(3).strip()
+            if op_str in NUM_SPEC_OPS:
+                try:
+                    num = float(num)
+                    if spec in num_spec_keys:
+                        return ('num_spec', spec, NUM_SPEC_OPS[op_str], num)
+                    elif spec in NUM_SPEC_ALIASES and NUM_SPEC_ALIASES[spec] in num_spec_keys:
+                        return ('num_spec', NUM_SPEC_ALIASES[spec], NUM_SPEC_OPS[op_str], num)
+                    else:
+                        ignored.append(f'Ignoring invalid num_spec \'{spec}\' in \'{term}\'')
+                except ValueError: ignored.append(f'Ignoring invalid number \'{num}\' in \'{term}\'')
+            else:
+                ignored.append(f'Ignoring invalid num_spec operator \'{m.group(2)}\' in \'{term}\'')
+        elif term.startswith('~'): # fuzzy name search
+            return ('fuzzy', term[1:].strip())
+        else: # generic value search
+            return ('search', term)
+    return None
+
+# yields terms of expr not under 'not'
+def expr_terms(node):
+    if node[0] in ['and', 'or']:
+        for child in node[1]:
+            yield from expr_terms(child)
+    elif node[0] != 'not':
+        yield node
+
 #results = [
 #    ( 'prod_num',
 #      part_db,
@@ -43,107 +254,665 @@ def pretty_duration(time_diff_secs):
 #    ...
 #]
 def search(query, db):
-    error = False
-    ops = {
-        '<':  operator.lt,
-        '<=': operator.le,
-        '=':  operator.eq,
-        '==': operator.eq,
-        '>=': operator.ge,
-        '>':  operator.gt,
-        '!=': operator.ne,
+    results, total, error = search_iter(query, db)
+    return list(results), error
+
+# returns (results generator, total matched count, error)
+# results are produced lazily in db order, or plan's sort order limited to plan's limit
+# max_results bounds sorted results like a limit without changing total
+def search_iter(query, db, max_results=None):
+    index = get_index(db)
+    plan = compile_query(normalize_query(query), index['info_keys'], index['num_spec_keys'])
+    for msg in plan.ignored: print(msg)
+
+    if not (plan.qs or plan.expr or plan.sort or plan.limit): return iter([]), 0, True
+
+    ords, scores = plan_ords(index, plan)
+    total = len(ords)
+    ords = order_ords(index, plan, ords, scores, max_results)
+    return (search_result(index, result_qs(plan), n) for n in ords), total, False
+
+# returns (ordinals of parts matching plan in db order, relevance scores of parts or None)
+# relevance-sorted plans rank generic terms with bm25 instead of requiring them
+def plan_ords(index, plan, trace=None):
+    scores = None
+    qs = plan.qs
+    if plan.sort and plan.sort[0] == 'relevance':
+        start = time.perf_counter()
+        scores = bm25_scores(index, ' '.join([q[1] for q in qs if q[0] == 'search']))
+        if trace is not None: trace.append((1, 'bm25 score > 0', None, int((scores > 0).sum()), time.perf_counter()-start))
+        qs = tuple([q for q in qs if q[0] != 'search'])
+    if plan.expr: ords = np.flatnonzero(expr_mask(index, plan.expr, trace))
+    else:         ords = query_ords(index, qs, trace)
+    if scores is not None: ords = ords[scores[ords] > 0]
+    return ords, scores
+
+# returns ords in plan's sort order limited to plan's limit or max_results
+def order_ords(index, plan, ords, scores=None, max_results=None):
+    limit = min([l for l in [plan.limit, max_results] if l] or [None])
+    if plan.sort and plan.sort[0] == 'relevance':
+        # select top-k by score, then sort only those (ties in db order)
+        if limit and limit < len(ords):
+            top = np.argpartition(-scores[ords], limit-1)[:limit]
+            ords = np.sort(ords[top])
+        ords = ords[np.argsort(-scores[ords], kind='stable')]
+    elif plan.sort:
+        num_spec, descending = plan.sort
+        values, present = index['num_specs'][num_spec]
+        # parts without num_spec are sorted last
+        keys = np.where(present, -values if descending else values, np.inf)[ords].tolist()
+        if limit: order = heapq.nsmallest(limit, range(len(ords)), key=keys.__getitem__)
+        else:     order = sorted(range(len(ords)), key=keys.__getitem__)
+        ords = ords[order]
+    elif plan.limit:
+        ords = ords[:plan.limit]
+    return ords
+
+# returns terms listed in result matches
+def result_qs(plan):
+    qs = plan.qs
+    if plan.sort and plan.sort[0] == 'relevance':
+        # list fields sharing words with ranked terms
+        qs = tuple([('tokens', q[1]) if q[0] == 'search' else q for q in qs])
+    elif plan.sort and plan.sort[0] not in [q[1] for q in qs if q[0] == 'num_spec']:
+        # list sort num_spec in results
+        qs += (('num_spec', plan.sort[0], None, ''),)
+    return qs
+
+# same as search() but also returns report of query plan and per-stage candidate counts and timings
+#report = {
+#    'query':   'query',
+#    'plan':    QueryPlan,
+#    'stages': [(depth, 'stage', estimated count or None, count or None, seconds), ...],
+#    'total':   count,
+#}
+def search_explain(query, db):
+    stages = []
+    index = get_index(db)
+
+    start = time.perf_counter()
+    hits = compile_query.cache_info().hits
+    plan = compile_query(normalize_query(query), index['info_keys'], index['num_spec_keys'])
+    cached = compile_query.cache_info().hits > hits
+    stages.append((0, f'compile{" (cached)" if cached else ""}', None, None, time.perf_counter()-start))
+
+    report = {
+        'query':  query,
+        'plan':   plan,
+        'stages': stages,
+        'total':  0,
     }
-    # parse query
-    #qs = [
-    #    ('search', term),
-    #    ('spec', spec, term),
-    #    ('num_spec', spec, term),
-    #    ...
-    #]
-    qs = []
-    for term in query.split(','):
-        term = term.strip()
-        m = re.match(r'(.*?):(.*)', term) # spec:'string' search
-        if m:
-            spec   = m.group(1).strip()
-            search = m.group(2).strip()
-
-            if str(spec).lower() in [k.lower() for k in db['keys']['info']] + ['product']:
-                qs.append(('spec', spec, search))
-            elif str(spec).lower() in SPEC_ALIASES:
-                qs.append(('spec', SPEC_ALIASES[spec], search))
-            else:
-                print(f'Ignoring invalid spec \'{spec}\' in \'{term}\'')
+    if not (plan.qs or plan.expr or plan.sort or plan.limit): return [], True, report
+
+    start = time.perf_counter()
+    ords, scores = plan_ords(index, plan, stages)
+    report['total'] = len(ords)
+    stages.append((0, 'filter', None, len(ords), time.perf_counter()-start))
+
+    if plan.sort or plan.limit:
+        start = time.perf_counter()
+        ords = order_ords(index, plan, ords, scores)
+        if plan.sort and plan.sort[0] == 'relevance': sort = 'rank by relevance'
+        elif plan.sort: sort = f'sort {"-" if plan.sort[1] else ""}{plan.sort[0]}'
+        else:           sort = ''
+        limit = f'limit {plan.limit}' if plan.limit else ''
+        stages.append((0, ', '.join([s for s in [sort, limit] if s]), None, len(ords), time.perf_counter()-start))
+
+    start = time.perf_counter()
+    qs = result_qs(plan)
+    results = [search_result(index, qs, n) for n in ords]
+    stages.append((0, 'collect matches', None, len(results), time.perf_counter()-start))
+    return results, False, report
+
+# returns ordinals of parts matching all queries in db order
+# queries are evaluated most selective first, each only against remaining candidates
+# appends (depth, term, estimate, candidates, seconds) of each query to trace if given
+def query_ords(index, qs, trace=None):
+    ords = np.arange(len(index['parts']))
+    estimates = {q: estimate_matches(index, q) for q in qs}
+    for q in sorted(qs, key=estimates.get):
+        if not len(ords): break
+        start = time.perf_counter()
+        if q[0] == 'num_spec':
+            _, num_spec, op, num = q
+            if num_spec not in index['num_specs']: return ords[:0]
+            values, present = index['num_specs'][num_spec]
+            if num == '': ords = ords[present[ords]]
+            else:         ords = ords[present[ords] & op(values[ords], num)]
+        elif q[0] == 'fuzzy':
+            ords = ords[fuzzy_lookup(index, q[1])[ords]]
+        elif q[0] == 'prefix':
+            ords = ords[prefix_lookup(index, q[1], q[2])[ords]]
+        elif len(ords) <= SEARCH_SCAN_MAX:
+            # few candidates left, cheaper to check them directly than to look up term
+            ords = ords[np.array([term_matches(index, q, n) for n in ords], dtype=bool)]
         else:
-            m = re.match(r'\s?([\w ]+)([=<>]+)\s?(.*)', term) # num_spec comparison search
-            if m:
-                spec =   m.group(1).strip()
-                op_str = m.group(2).strip()
-                num    = m.group(3).strip()
-                if op_str in ops:
-                    try:
-                        float(num)
-                        if spec in db['keys']['num_specs']:
-                            qs.append(('num_spec', spec, ops[op_str], num))
-                        elif spec in NUM_SPEC_ALIASES and NUM_SPEC_ALIASES[spec] in db['keys']['num_specs']:
-                            qs.append(('num_spec', NUM_SPEC_ALIASES[spec], ops[op_str], num))
-                        else:
-                            print(f'Ignoring invalid num_spec \'{spec}\' in \'{term}\'')
-                    except ValueError: print(f'Ignoring invalid number \'{num}\' in \'{term}\'')
+            ords = ords[index_lookup(index, q)[ords]]
+        if trace is not None: trace.append((1, format_term(index, q), estimates[q], len(ords), time.perf_counter()-start))
+    return ords
+
+# returns mask of parts matching boolean expression
+# appends (depth, node, estimate, matches, seconds) of each node to trace if given
+def expr_mask(index, node, trace=None, depth=1):
+    start = time.perf_counter()
+    if trace is not None:
+        pos = len(trace)
+    if node[0] == 'and':
+        mask = np.ones(len(index['parts']), dtype=bool)
+        for child in sorted(node[1], key=lambda child: expr_estimate(index, child)):
+            mask &= expr_mask(index, child, trace, depth+1)
+            if not mask.any(): break
+    elif node[0] == 'or':
+        mask = np.zeros(len(index['parts']), dtype=bool)
+        for child in node[1]:
+            mask |= expr_mask(index, child, trace, depth+1)
+    elif node[0] == 'not':
+        mask = ~expr_mask(index, node[1], trace, depth+1)
+    else:
+        mask = term_mask(index, node)
+    if trace is not None:
+        description = node[0].upper() if node[0] in ['and', 'or', 'not'] else format_term(index, node)
+        trace.insert(pos, (depth, description, expr_estimate(index, node), int(mask.sum()), time.perf_counter()-start))
+    return mask
+
+def expr_estimate(index, node):
+    if node[0] == 'and': return min([expr_estimate(index, child) for child in node[1]])
+    if node[0] == 'or':  return min(sum([expr_estimate(index, child) for child in node[1]]), len(index['parts']))
+    if node[0] == 'not': return len(index['parts'])-expr_estimate(index, node[1])
+    return estimate_matches(index, node)
+
+# returns readable description of query term
+def format_term(index, q):
+    if q[0] == 'search':
+        return f'any field contains \'{q[1]}\''
+    elif q[0] == 'spec':
+        return f'{"product line" if q[1] == "product" else q[1]} contains \'{q[2]}\''
+    elif q[0] == 'num_spec':
+        _, num_spec, op, num = q
+        if num == '': return f'{num_spec} exists'
+        op_str = [k for k, v in NUM_SPEC_OPS.items() if v == op][-1]
+        return f'{num_spec} {op_str} {num:g}'
+    elif q[0] == 'fuzzy':
+        similar = sorted(set().union(*[fuzzy_words(index, word) for word in tokenize(q[1])]))
+        return f'names similar to \'{q[1]}\' ({", ".join(similar) if similar else "no similar words"})'
+    elif q[0] == 'prefix':
+        return f'{"product line" if q[1] == "product" else q[1]} starts with \'{q[2]}\''
+
+# takes (results, error, report) return value from search_explain()
+def format_explain(report):
+    plan = report['plan']
+    contents = f'query: {report["query"]}\n'
+    if plan.ignored:
+        contents += 'ignored:\n'
+        for msg in plan.ignored:
+            contents += f'  {msg}\n'
+    contents += '\n'
+
+    name_width = max([len('  '*depth+name) for depth, name, _, _, _ in report['stages']]+[5])
+    contents += f'{"stage":{name_width}} {"est":>6} {"parts":>6} {"ms":>8}\n'
+    for depth, name, estimate, count, secs in report['stages']:
+        est_str   = '' if estimate is None else str(int(estimate))
+        count_str = '' if count is None else str(count)
+        contents += f'{"  "*depth+name:{name_width}} {est_str:>6} {count_str:>6} {secs*1000:8.3f}\n'
+    contents += f'\n{report["total"]} matching parts'
+    return contents
+
+# returns mask of parts matching single query term
+def term_mask(index, q):
+    if q[0] == 'num_spec':
+        _, num_spec, op, num = q
+        if num_spec not in index['num_specs']: return np.zeros(len(index['parts']), dtype=bool)
+        values, present = index['num_specs'][num_spec]
+        if num == '': return present.copy()
+        return present & op(values, num)
+    elif q[0] == 'fuzzy':
+        return fuzzy_lookup(index, q[1])
+    elif q[0] == 'prefix':
+        return prefix_lookup(index, q[1], q[2])
+    else:
+        return index_lookup(index, q)
+
+# returns estimated number of parts matching query from index stats
+def estimate_matches(index, q):
+    stats = index['stats']
+    total = len(index['parts'])
+    if q[0] == 'num_spec':
+        _, num_spec, op, num = q
+        if num_spec not in stats['num_specs']: return 0
+        values = stats['num_specs'][num_spec]
+        if num == '': return len(values)
+        left  = np.searchsorted(values, num, side='left')
+        right = np.searchsorted(values, num, side='right')
+        return {
+            operator.lt: left,
+            operator.le: right,
+            operator.eq: right-left,
+            operator.ge: len(values)-left,
+            operator.gt: len(values)-right,
+            operator.ne: len(values)-(right-left),
+        }[op]
+    elif q[0] == 'fuzzy':
+        return total
+    elif q[0] == 'prefix':
+        keys, names, ords = index['prefixes'][q[1]]
+        lo, hi = prefix_range(keys, q[2])
+        if q[1] == 'product': return sum([len(o) for o in ords[lo:hi]])
+        return hi-lo
+    else:
+        term = q[-1]
+        spec = q[1] if q[0] == 'spec' else None
+        if spec == 'product' or len(term) < 3: estimate = total
+        else: estimate = min([stats['trigram_parts'].get(tri, 0) for tri in trigrams(term)]+[total])
+        if spec not in [None, 'product']: estimate = min(estimate, stats['spec_parts'].get(spec, 0))
+        return estimate
+
+# returns whether part ordinal n matches ('search', term) or ('spec', spec, term)
+def term_matches(index, q, n):
+    lower = index['lower'][n]
+    if q[0] == 'search':
+        return any([q[1] in v for k, v in lower.items() if k not in GENERIC_SKIP_SPECS])
+    spec = 'product line' if q[1] == 'product' else q[1]
+    if q[0] == 'prefix':
+        return spec in lower and lower[spec].strip().startswith(q[2])
+    return spec in lower and q[2] in lower[spec]
+
+# returns (prod, part, matches) for part ordinal n matching qs
+def search_result(index, qs, n):
+    brand, prod, part = index['parts'][n]
+    lower = index['lower'][n]
+    matches = []
+    for q in qs:
+        if q[0] == 'search':
+            term = q[1]
+            # product line search (special case since product line not in part dictionary)
+            if term in lower['product line']:
+                matches.append(('product line', prod))
+            # generic search
+            for k, v in lower.items():
+                if k != 'product line' and k not in GENERIC_SKIP_SPECS and term in v:
+                    matches.append((k, part[k]))
+        elif q[0] in ['spec', 'prefix']:
+            spec = q[1]
+            if term_matches(index, q, n):
+                # product line search (special case since product line not in part dictionary)
+                if spec == 'product':
+                    matches.append(('product line', prod))
+                # spec search
                 else:
-                    print(f'Ignoring invalid num_spec operator \'{m.group(2)}\' in \'{term}\'')
-            else: # generic value search
-                qs.append(('search', term))
-    #pprint(qs)
-    results = []
-    if qs:
-        for brand, prods in db['data'].items():
-            for prod, parts in prods.items():
-                for part in parts:
-                    matches = []
-                    qs_matched = [False]*len(qs)
-                    search_matched = False
-                    for i in range(len(qs)):
-                        q = qs[i]
-                        if q[0] == 'search':
-                            term = q[1]
-                            # product line search (special case since product line not in part dictionary)
-                            if term.lower() in prod.lower():
-                                matches.append(('product line', prod))
-                                qs_matched[i] = True
-                            # generic search
-                            for k, v in part.items():
-                                # dont search summary
-                                if k != 'summary' and type(v) == str and term.lower() in v.lower():
-                                    matches.append((k, v))
-                                    qs_matched[i] = True
-                        elif q[0] == 'spec':
-                            spec = q[1]
-                            term = q[2]
-                            # product line search (special case since product line not in part dictionary)
-                            if spec == 'product':
-                                if term.lower() in prod.lower():
-                                    matches.append(('product line', prod))
-                                    qs_matched[i] = True
-                            # spec search
-                            else:
-                                if spec in part and term.lower() in part[spec].lower():
-                                    matches.append((spec, part[spec]))
-                                    qs_matched[i] = True
-                        elif q[0] == 'num_spec':
-                            num_spec = q[1]
-                            op       = q[2]
-                            num      = q[3]
-                            if num_spec in part['num_specs'] and (num == '' or op(part['num_specs'][num_spec][0], float(num))):
-                                matches.append((num_spec, f'{part["num_specs"][num_spec][0]} {part["num_specs"][num_spec][1]}'))
-                                qs_matched[i] = True
-
-                    # if all queries matched, add to result list
-                    if qs_matched.count(True) == len(qs):
-                        results.append((prod, part, matches))
-    else: error = True
-
-    return results, error
+                    matches.append((spec, part[spec]))
+        elif q[0] == 'tokens':
+            words = set(tokenize(q[1]))
+            if words & set(tokenize(lower['product line'])):
+                matches.append(('product line', prod))
+            for k, v in lower.items():
+                if k != 'product line' and k not in GENERIC_SKIP_SPECS and words & set(tokenize(v)):
+                    matches.append((k, part[k]))
+        elif q[0] == 'fuzzy':
+            similar = set().union(*[fuzzy_words(index, word) for word in tokenize(q[1])])
+            if similar & set(tokenize(part['name'])):
+                matches.append(('name', part['name']))
+            prod_name = index['prod_names'].get(prod, '')
+            if similar & set(tokenize(prod_name)):
+                matches.append(('product line', prod_name))
+        elif q[0] == 'num_spec':
+            _, num_spec, op, num = q
+            if num_spec in part['num_specs'] and (num == '' or op(part['num_specs'][num_spec][0], num)):
+                matches.append((num_spec, f'{part["num_specs"][num_spec][0]} {part["num_specs"][num_spec][1]}'))
+    return prod, part, matches
+
+# search_iter() with results cached per (region, normalized query, db timestamp)
+# results are materialized up to max_results
+# least recently used entries are evicted past SEARCH_CACHE_MAX_ENTRIES or SEARCH_CACHE_MAX_BYTES
+# returns (results, total matched count, error)
+def cached_search(query, db, max_results=None):
+    key = (db['metadata']['short region'], normalize_query(query), db['metadata']['timestamp'], max_results)
+    entries = SEARCH_CACHE['entries']
+    with SEARCH_CACHE['lock']:
+        if key in entries:
+            SEARCH_CACHE['hits'] += 1
+            entries.move_to_end(key)
+            return entries[key][0]
+        SEARCH_CACHE['misses'] += 1
+
+    results, total, error = search_iter(query, db, max_results)
+    ret = (list(itertools.islice(results, max_results)), total, error)
+    size = results_size(ret[0])
+    if size <= SEARCH_CACHE_MAX_BYTES:
+        with SEARCH_CACHE['lock']:
+            if key not in entries:
+                entries[key] = (ret, size)
+                SEARCH_CACHE['bytes'] += size
+            while len(entries) > SEARCH_CACHE_MAX_ENTRIES or SEARCH_CACHE['bytes'] > SEARCH_CACHE_MAX_BYTES:
+                _, (_, evicted_size) = entries.popitem(last=False)
+                SEARCH_CACHE['bytes'] -= evicted_size
+    return ret
+
+# runs cached_search() on every db in turn
+# search is GIL-bound pure python, a thread pool made the fan-out slower than this loop
+# returns { 'short_region': (results, total, error), ... } in dbs order
+def search_all(query, dbs, max_results=None):
+    return {region: cached_search(query, db, max_results) for region, db in dbs.items()}
+
+# approximate memory held by cached results (part dicts are shared with db and not counted)
+def results_size(results):
+    size = sys.getsizeof(results)
+    for result in results:
+        size += sys.getsizeof(result) + sys.getsizeof(result[2])
+        size += sum([sys.getsizeof(match) for match in result[2]])
+    return size
+
+# drop cached results of region, called when region's db is reloaded
+def invalidate_search_cache(region):
+    entries = SEARCH_CACHE['entries']
+    with SEARCH_CACHE['lock']:
+        for key in [key for key in entries if key[0] == region]:
+            _, size = entries.pop(key)
+            SEARCH_CACHE['bytes'] -= size
+
+def get_search_cache_stats():
+    total = SEARCH_CACHE['hits'] + SEARCH_CACHE['misses']
+    return {
+        'entries':  len(SEARCH_CACHE['entries']),
+        'bytes':    SEARCH_CACHE['bytes'],
+        'hits':     SEARCH_CACHE['hits'],
+        'misses':   SEARCH_CACHE['misses'],
+        'hit rate': SEARCH_CACHE['hits']/total if total else 0.0,
+    }
+
+#index = {
+#    'parts':     [(brand, prod, part_db), ...], # part ordinal -> part
+#    'values':    { 'value': { 'spec': np.array([ordinal, ...]), ... }, ... }, # lowercase string values
+#    'prods':     { 'prod': np.array([ordinal, ...]), ... }, # lowercase product line codes
+#    'trigrams':  { 'tri': {'value', ...}, ... }, # value trigrams for substring lookup
+#    'num_specs': { 'num_spec': (np.array([num, ...]), np.array([present, ...])), ... },
+#    'lower':     [{ 'product line': 'prod', 'spec': 'value', ... }, ...], # lowercase view of each part
+#    'info_keys':     frozenset(['spec', ...]), # valid specs for query plans
+#    'num_spec_keys': frozenset(['num_spec', ...]),
+#    'stats': { # per-region statistics for query selectivity estimates
+#        'trigram_parts': { 'tri': count, ... }, # upper bound of parts containing trigram
+#        'spec_parts':    { 'spec': count, ... },
+#        'num_specs':     { 'num_spec': np.array([sorted num, ...]), ... },
+#    },
+#    'prod_names':    { 'prod': 'product line name', ... }, # from db['brands']
+#    'words':         { 'word': np.array([ordinal, ...]), ... }, # words of part and product line names
+#    'word_trigrams': { 'tri': {'word', ...}, ... }, # padded word trigrams for fuzzy lookup
+#    'fuzzy_words':   OrderedDict({ 'word': {'similar word', ...}, ... }), # fuzzy_words() lru, FUZZY_WORDS_CACHE_MAX
+#    'fuzzy lock':    threading.Lock(),
+#    'pns':   { 'part number (normalized)': (brand, prod, part_db), ... },
+#    'history rows': (history['rows'], np.array([history row or -1, ...])), # added by get_index_history_rows()
+#    'prefixes': { # sorted keys for prefix lookup with bisect
+#        'part number': (['key', ...], ['Key', ...], np.array([ordinal, ...])), # normalized, original, part
+#        'product':     (['key', ...], ['Key', ...], [np.array([ordinal, ...]), ...]), # incl. db['brands']
+#    },
+#    'bm25': { # term statistics for relevance ranking over names, product line and specs
+#        'postings': { 'word': (np.array([ordinal, ...]), np.array([term freq, ...]), idf), ... },
+#        'lengths':  np.array([words in part, ...]),
+#        'avg length': float,
+#    },
+#}
+def build_index(db):
+    index = {
+        'parts':     [],
+        'values':    {},
+        'prods':     {},
+        'trigrams':  {},
+        'num_specs': {},
+        'lower':     [],
+        'info_keys':     frozenset([k.lower() for k in db['keys']['info']] + ['product']),
+        'num_spec_keys': frozenset(db['keys']['num_specs']),
+        'stats': {
+            'trigram_parts': {},
+            'spec_parts':    {},
+            'num_specs':     {},
+        },
+        'prod_names':    {},
+        'words':         {},
+        'word_trigrams': {},
+        'fuzzy_words':   OrderedDict(),
+        'fuzzy lock':    threading.Lock(),
+        'pns':  build_pn_index(db),
+        'prefixes': {},
+        'bm25': {
+            'postings':   {},
+            'lengths':    [],
+            'avg length': 0.0,
+        },
+    }
+    bm25 = index['bm25']
+    # word occurrences of all parts, counted into bm25 postings after loop
+    word_ids = {}
+    value_words = {} # memoized word ids of repeated values
+    word_occurrences = []
+    occurrence_ords = []
+    stats = index['stats']
+    num_specs = {}
+    for brand, prods in db['brands'].items():
+        for prod, prod_name in prods:
+            index['prod_names'][prod] = prod_name
+    for brand, prods in db['data'].items():
+        for prod, parts in prods.items():
+            for part in parts:
+                i = len(index['parts'])
+                index['parts'].append((brand, prod, part))
+                index['prods'].setdefault(prod.lower(), []).append(i)
+                lower = {'product line': prod.lower()}
+                for k, v in part.items():
+                    # summary is indexed for spec:term lookups, generic terms skip GENERIC_SKIP_SPECS
+                    if type(v) == str:
+                        lower[k] = v.lower()
+                        index['values'].setdefault(lower[k], {}).setdefault(k, []).append(i)
+                index['lower'].append(lower)
+                for word in set(tokenize(part['name']) + tokenize(index['prod_names'].get(prod, ''))):
+                    index['words'].setdefault(word, []).append(i)
+                # name and product line name are in lower view as 'name' and 'product line' code
+                length = 0
+                for v in [index['prod_names'].get(prod, '').lower()] + [v for k, v in lower.items() if k not in GENERIC_SKIP_SPECS]:
+                    if v not in value_words:
+                        value_words[v] = [word_ids.setdefault(word, len(word_ids)) for word in tokenize(v)]
+                    word_occurrences.extend(value_words[v])
+                    length += len(value_words[v])
+                occurrence_ords.extend([i]*length)
+                bm25['lengths'].append(length)
+                for k, v in part['num_specs'].items():
+                    num_specs.setdefault(k, []).append((i, v[0]))
+
+    # convert postings to arrays
+    for prod, ords in index['prods'].items():
+        index['prods'][prod] = np.array(ords, dtype=np.intp)
+    for value, specs in index['values'].items():
+        value_parts = 0
+        for spec, ords in specs.items():
+            specs[spec] = np.array(ords, dtype=np.intp)
+            stats['spec_parts'][spec] = stats['spec_parts'].get(spec, 0) + len(ords)
+            value_parts += len(ords)
+        for tri in trigrams(value):
+            index['trigrams'].setdefault(tri, set()).add(value)
+            stats['trigram_parts'][tri] = stats['trigram_parts'].get(tri, 0) + value_parts
+    total = len(index['parts'])
+    # count (word, part) occurrences, sorted by word then part
+    pairs, tfs = np.unique(
+        np.array(word_occurrences, dtype=np.int64)*max(total, 1) + np.array(occurrence_ords, dtype=np.int64),
+        return_counts=True,
+    )
+    pair_words = pairs // max(total, 1)
+    bounds = np.searchsorted(pair_words, np.arange(len(word_ids)+1))
+    for word, word_id in word_ids.items():
+        ords = (pairs[bounds[word_id]:bounds[word_id+1]] % max(total, 1)).astype(np.intp)
+        idf = math.log(1 + (total-len(ords)+0.5)/(len(ords)+0.5))
+        bm25['postings'][word] = (ords, tfs[bounds[word_id]:bounds[word_id+1]].astype(np.float32), idf)
+    bm25['lengths'] = np.array(bm25['lengths'], dtype=np.float32)
+    bm25['avg length'] = float(bm25['lengths'].mean()) if total else 0.0
+    for word, ords in index['words'].items():
+        index['words'][word] = np.array(ords, dtype=np.intp)
+        for tri in padded_trigrams(word):
+            index['word_trigrams'].setdefault(tri, set()).add(word)
+
+    # sort part numbers and product line codes for prefix lookup
+    pns = sorted([(normalize_pn(part['part number']), part['part number'], i) for i, (brand, prod, part) in enumerate(index['parts'])])
+    prods = {prod.lower(): prod for brand, prods in db['brands'].items() for prod, prod_name in prods}
+    prods.update({prod.lower(): prod for brand, prods in db['data'].items() for prod in prods})
+    prods = sorted(prods.items())
+    index['prefixes']['part number'] = (
+        [key for key, pn, i in pns],
+        [pn for key, pn, i in pns],
+        np.array([i for key, pn, i in pns], dtype=np.intp),
+    )
+    index['prefixes']['product'] = (
+        [key for key, prod in prods],
+        [prod for key, prod in prods],
+        [index['prods'].get(key, np.array([], dtype=np.intp)) for key, prod in prods],
+    )
+
+    # store num_specs as columns with presence mask
+    for num_spec, entries in num_specs.items():
+        values  = np.zeros(len(index['parts']), dtype=np.float64)
+        present = np.zeros(len(index['parts']), dtype=bool)
+        ords, nums = zip(*entries)
+        values[list(ords)]  = nums
+        present[list(ords)] = True
+        index['num_specs'][num_spec] = (values, present)
+        stats['num_specs'][num_spec] = np.sort(values[present])
+    return index
+
+def get_index(db):
+    if 'index' not in db: db['index'] = build_index(db)
+    return db['index']
+
+def trigrams(s):
+    return {s[i:i+3] for i in range(len(s)-2)}
+
+# padding lets short words and word boundaries contribute trigrams
+def padded_trigrams(word):
+    return trigrams(f'  {word} ')
+
+def tokenize(s):
+    return re.findall(r'[a-z0-9]+', s.lower())
+
+# returns words of part and product line names similar to word
+# similarity is dice coefficient of padded trigrams
+# results are memoized, least recently used words are evicted past FUZZY_WORDS_CACHE_MAX
+def fuzzy_words(index, word):
+    cache = index['fuzzy_words']
+    with index['fuzzy lock']:
+        if word in cache:
+            cache.move_to_end(word)
+            return cache[word]
+    tris = padded_trigrams(word)
+    shared = {}
+    for tri in tris:
+        for w in index['word_trigrams'].get(tri, ()):
+            shared[w] = shared.get(w, 0) + 1
+    similar = set()
+    for w, count in shared.items():
+        if 2*count/(len(tris)+len(padded_trigrams(w))) >= FUZZY_MIN_SIMILARITY:
+            similar.add(w)
+    with index['fuzzy lock']:
+        cache[word] = similar
+        while len(cache) > FUZZY_WORDS_CACHE_MAX:
+            cache.popitem(last=False)
+    return similar
+
+# returns bm25 relevance score of every part for words of terms
+def bm25_scores(index, terms):
+    bm25 = index['bm25']
+    scores = np.zeros(len(index['parts']), dtype=np.float32)
+    for word in set(tokenize(terms)):
+        if word in bm25['postings']:
+            ords, tfs, idf = bm25['postings'][word]
+            norm = BM25_K1*(1-BM25_B+BM25_B*bm25['lengths'][ords]/bm25['avg length'])
+            scores[ords] += idf*tfs*(BM25_K1+1)/(tfs+norm)
+    return scores
+
+# returns mask of parts whose part or product line names contain words similar to every word of term
+def fuzzy_lookup(index, term):
+    words = tokenize(term)
+    mask = np.ones(len(index['parts']), dtype=bool) if words else np.zeros(len(index['parts']), dtype=bool)
+    for word in words:
+        word_mask = np.zeros(len(index['parts']), dtype=bool)
+        for w in fuzzy_words(index, word):
+            word_mask[index['words'][w]] = True
+        mask &= word_mask
+    return mask
+
+# returns mask of parts whose values contain term
+# takes ('search', term) or ('spec', spec, term) from parsed query
+def index_lookup(index, q):
+    term = q[-1]
+    spec = q[1] if q[0] == 'spec' else None
+
+    mask = np.zeros(len(index['parts']), dtype=bool)
+    if spec is None or spec == 'product':
+        for prod, ords in index['prods'].items():
+            if term in prod: mask[ords] = True
+    if spec != 'product':
+        # values containing term must contain all of its trigrams
+        if len(term) >= 3:
+            tris = trigrams(term)
+            if not all([tri in index['trigrams'] for tri in tris]): return mask
+            tri_values = sorted([index['trigrams'][tri] for tri in tris], key=len)
+            values = set.intersection(*tri_values)
+        else: values = index['values'].keys()
+        for value in values:
+            if term in value:
+                if spec is None:
+                    for value_spec, ords in index['values'][value].items():
+                        if value_spec not in GENERIC_SKIP_SPECS: mask[ords] = True
+                elif spec in index['values'][value]:
+                    mask[index['values'][value][spec]] = True
+    return mask
+
+# returns (lo, hi) range of sorted keys starting with prefix
+def prefix_range(keys, prefix):
+    return bisect.bisect_left(keys, prefix), bisect.bisect_right(keys, prefix+chr(0x10ffff))
+
+# returns mask of parts whose part number or product line code ('part number' or 'product' spec) starts with prefix
+def prefix_lookup(index, spec, prefix):
+    keys, names, ords = index['prefixes'][spec]
+    lo, hi = prefix_range(keys, prefix)
+    mask = np.zeros(len(index['parts']), dtype=bool)
+    if spec == 'product':
+        for prod_ords in ords[lo:hi]: mask[prod_ords] = True
+    else:
+        mask[ords[lo:hi]] = True
+    return mask
+
+# returns [(completion, spec, ['short_region', ...]), ...] sorted
+# for part numbers and product line codes of dbs starting with prefix
+def complete(prefix, dbs, limit=None):
+    if not limit: limit = COMPLETE_MAX_RESULTS
+    prefix = normalize_pn(prefix)
+    found = {}
+    for region, db in dbs.items():
+        index = get_index(db)
+        for spec, (keys, names, ords) in index['prefixes'].items():
+            lo, hi = prefix_range(keys, prefix)
+            # overall first completions are among first completions of each db
+            for name in names[lo:min(hi, lo+limit)]:
+                regions = found.setdefault((name.lower(), name, spec), [])
+                if region not in regions: regions.append(region)
+    return [(name, spec, regions) for (key, name, spec), regions in sorted(found.items())[:limit]]
+
+# returns { 'part number (normalized)': (brand, prod, part_db), ... }
+def build_pn_index(db):
+    pns = {}
+    for brand, prods in db['data'].items():
+        for prod, parts in prods.items():
+            for part in parts:
+                pns.setdefault(normalize_pn(part['part number']), (brand, prod, part))
+    return pns
+
+# loaded dbs keep part number index in db index, others (e.g. backups) build it on first use
+def get_pn_index(db):
+    if 'index' in db: return db['index']['pns']
+    if 'pn index' not in db: db['pn index'] = build_pn_index(db)
+    return db['pn index']
+
+def normalize_pn(pn):
+    return pn.strip().lower()
+
+# returns (brand, prod, part_db) or None if part_num not found
+def find_part(part_num, db):
+    return get_pn_index(db).get(normalize_pn(part_num))
 
 # returns (None, None) if part_num not found
 #         (info, {})    if part_num found but no specs matched
@@ -151,29 +920,28 @@ def search(query, db):
 def get_specs(part_num, db, specs=[]):
     ret_specs = {}
     info = {}
-    for brand, prods in db['data'].items():
-        for prod, parts in prods.items():
-            for part in parts:
-                if part_num.strip().lower() == part['part number'].strip().lower():
-                    info['name'] = part['name']
-                    info['part number'] = part['part number']
-                    info['price'] = part['num_specs']['price']
-                    info['status'] = part['status']
-                    if not specs:
-                        ret_specs = part
-                    else:
-                        # replace spec aliases with real spec
-                        for i in range(len(specs)):
-                            if specs[i] in SPEC_ALIASES: specs[i] = SPEC_ALIASES[specs[i]]
-                            elif specs[i] in NUM_SPEC_ALIASES: specs[i] = NUM_SPEC_ALIASES[specs[i]]
-
-                        # if spec is both normal spec and num spec, ignore num spec
-                        for spec in specs:
-                            if spec in part:
-                                ret_specs[spec] = part[spec]
-                            elif spec in part['num_specs']:
-                                ret_specs[spec] = f'{part["num_specs"][spec][0]} {part["num_specs"][spec][1]}'
-                    return info, ret_specs
+    found = find_part(part_num, db)
+    if found:
+        brand, prod, part = found
+        info['name'] = part['name']
+        info['part number'] = part['part number']
+        info['price'] = part['num_specs']['price']
+        info['status'] = part['status']
+        if not specs:
+            ret_specs = part
+        else:
+            # replace spec aliases with real spec
+            for i in range(len(specs)):
+                if specs[i] in SPEC_ALIASES: specs[i] = SPEC_ALIASES[specs[i]]
+                elif specs[i] in NUM_SPEC_ALIASES: specs[i] = NUM_SPEC_ALIASES[specs[i]]
+
+            # if spec is both normal spec and num spec, ignore num spec
+            for spec in specs:
+                if spec in part:
+                    ret_specs[spec] = part[spec]
+                elif spec in part['num_specs']:
+                    ret_specs[spec] = f'{part["num_specs"][spec][0]} {part["num_specs"][spec][1]}'
+        return info, ret_specs
     return None, None
 
 # takes (info, specs) return value from get_specs()
@@ -213,6 +981,83 @@ def format_specs(db, info, specs):
 
     return contents
 
+# returns ([part_db, ...], [missing part_num, ...]) in given order
+def get_parts(part_nums, db):
+    parts = []
+    missing = []
+    pns = get_pn_index(db)
+    for part_num in part_nums:
+        found = pns.get(normalize_pn(part_num))
+        if found: parts.append(found[2])
+        else:     missing.append(part_num)
+    return parts, missing
+
+# returns ([(spec, [value, ...], differs), ...], [unknown spec, ...])
+# lists all specs of parts if no specs are given
+def compare_specs(parts, specs=[]):
+    if specs:
+        # replace spec aliases with real spec
+        specs = [SPEC_ALIASES.get(s, NUM_SPEC_ALIASES.get(s, s)) for s in specs]
+    else:
+        specs = []
+        for part in parts:
+            specs += [k for k in part if k not in specs and k not in ['num_specs', 'part number']]
+        num_specs = []
+        for part in parts:
+            num_specs += [k for k in part['num_specs'] if k not in num_specs and k not in specs]
+        specs += num_specs
+
+    rows = []
+    unknown = []
+    for spec in dict.fromkeys(specs):
+        values = []
+        for part in parts:
+            # if spec is both normal spec and num spec, ignore num spec
+            if spec in part:
+                value = part[spec]
+                if spec == 'processor': value = cleanup_cpu(value)
+            elif spec in part['num_specs']:
+                value = f'{part["num_specs"][spec][0]} {part["num_specs"][spec][1]}'
+            else:
+                value = None
+            values.append(value)
+        if all(v is None for v in values):
+            unknown.append(spec)
+            continue
+        values = ['-' if v is None else str(v) for v in values]
+        rows.append((spec, values, len(set(values)) > 1))
+    return rows, unknown
+
+# aligned table with one column per part, long values are wrapped within their column
+# rows that differ between parts are marked with '*'
+# columns fit part numbers, words and values up to COMPARE_NOWRAP_WIDTH without wrapping,
+# parts that don't fit within max_width continue in further blocks of columns
+def format_compare(parts, rows, max_width=73):
+    spacing = max([len(spec) for spec, values, differs in rows], default=0)
+    available = max_width - spacing - 2
+    min_width = max(
+        [len(p['part number']) for p in parts]
+        + [len(v) if len(v) <= COMPARE_NOWRAP_WIDTH else max([len(w) for w in v.split()], default=0)
+            for spec, values, differs in rows for v in values]
+        + [8]
+    )
+    min_width = max(min(min_width, available-2), 8)
+    per_block = max(available // (min_width+2), 1)
+
+    blocks = []
+    for start in range(0, len(parts), per_block):
+        cols = range(start, min(start+per_block, len(parts)))
+        width = max(available // len(cols) - 2, min_width)
+        lines = [f'  {"":>{spacing}}  ' + '  '.join([f'{parts[j]["part number"]:{width}}' for j in cols])]
+        for spec, values, differs in rows:
+            cells = [textwrap.wrap(values[j], width) or [''] for j in cols]
+            for i, line in enumerate(itertools.zip_longest(*cells, fillvalue='')):
+                mark = '*' if differs and i == 0 else ' '
+                name = spec if i == 0 else ''
+                lines.append(f'{mark} {name:>{spacing}}  ' + '  '.join([f'{c:{width}}' for c in line]))
+        blocks.append('\n'.join([f'`{l.rstrip()}`' for l in lines]) + '\n')
+    return '\n'.join(blocks)
+
 def get_specs_psref(s, pn, specs=[]):
     info = {}
     ret_specs = {}
@@ -437,33 +1282,273 @@ def cleanup_gpu(gpu, level=0):
 
 # returns ([(dt:datetime, price:str, unavailable:bool) ...], part:dict)
 def get_history(pn, dbs):
-    data = []
-    part = None
-
-    for db in dbs:
-        dt = datetime.utcfromtimestamp(db['metadata']['timestamp'])
-        found = False
-        if pn in db['prices']:
-            data.append((dt, db['prices'][pn][0], False))
-        else:
-            data.append((dt, -100, False))
-
-        if part is None:
-            found = False
-            for brand, prods in db['data'].items():
-                if found: break
-                for prod, parts in prods.items():
-                    if found: break
-                    for p in parts:
-                        if pn == p['part number']:
-                            part = p
-                            found = True
-                            break
-
-    return data, part
+    dates, prices, parts = get_histories([pn], dbs)
+    data = [(dt, price, False) for dt, price in zip(dates, prices[0].tolist())]
+    return data, parts[0]
+
+# extracts prices of all part numbers in one pass over dbs
+# returns ([dt:datetime, ...], np.array([[price or -100, ...], ...]) part numbers x dbs, [part:dict or None, ...])
+def get_histories(pns, dbs):
+    dates  = []
+    prices = np.full((len(pns), len(dbs)), -100.0)
+    parts  = [None]*len(pns)
+    # prices are keyed by exact part number, resolved from earliest db containing part
+    keys = [pn.strip() for pn in pns]
+    for col, db in enumerate(dbs):
+        dates.append(datetime.utcfromtimestamp(db['metadata']['timestamp']))
+        for i, pn in enumerate(pns):
+            if parts[i] is None:
+                found = find_part(pn, db)
+                if found:
+                    parts[i] = found[2]
+                    keys[i]  = found[2]['part number']
+            if keys[i] in db['prices']: prices[i, col] = db['prices'][keys[i]][0]
+    return dates, prices, parts
+
+# price matrix of all parts over all snapshots of a region
+#history = {
+#    'region': 'short_region',
+#    'ts':     np.array([timestamp, ...]), # sorted snapshot timestamps
+#    'prices': np.array([[price or nan, ...], ...], dtype=np.float32), # parts x snapshots, nan if not listed
+#    'rows':   { 'part number (normalized)': row, ... },
+#    'low':    np.array([lowest price or nan, ...], dtype=np.float32), # per row, updated with each snapshot
+#    'low ts': np.array([timestamp lowest price was first seen or nan, ...]),
+#    'high':   np.array([highest price or nan, ...], dtype=np.float32),
+#    'lock':   threading.Lock(), # arrays are replaced, not modified, on update
+#}
+def new_history(region):
+    return {
+        'region': region,
+        'ts':     np.zeros(0, dtype=np.float64),
+        'prices': np.zeros((0, 0), dtype=np.float32),
+        'rows':   {},
+        'low':    np.zeros(0, dtype=np.float32),
+        'low ts': np.zeros(0, dtype=np.float64),
+        'high':   np.zeros(0, dtype=np.float32),
+        'lock':   threading.Lock(),
+    }
+
+# returns (timestamp, { 'part number': price, ... }) of db
+def price_snapshot(db):
+    return db['metadata']['timestamp'], {pn: price[0] for pn, price in db['prices'].items()}
+
+# returns [(timestamp, { 'part number': price, ... }), ...] of region's backup dbs
+def get_backup_price_snapshots(backup_dir, region):
+    return [price_snapshot(snapshots.load_snapshot(entry['path'])) for entry in snapshots.list_snapshots(backup_dir, region)]
+
+# builds history from [(timestamp, { 'part number': price, ... }), ...]
+# snapshots with same timestamp are stored once
+def build_history(region, snaps):
+    history = new_history(region)
+    snaps = sorted(dict(snaps).items(), key=lambda s: s[0])
+    rows = {}
+    for ts, prices in snaps:
+        for pn in prices: rows.setdefault(normalize_pn(pn), len(rows))
+
+    matrix = np.full((len(rows), len(snaps)), np.nan, dtype=np.float32)
+    for col, (ts, prices) in enumerate(snaps):
+        matrix[[rows[normalize_pn(pn)] for pn in prices], col] = list(prices.values())
+    history['ts']     = np.array([ts for ts, prices in snaps], dtype=np.float64)
+    history['prices'] = matrix
+    history['rows']   = rows
+
+    valid = np.where(matrix > 0, matrix, np.nan)
+    history['low']  = np.fmin.reduce(valid, axis=1, initial=np.nan)
+    history['high'] = np.fmax.reduce(valid, axis=1, initial=np.nan)
+    at_low = valid == history['low'][:, None]
+    history['low ts'] = np.where(at_low.any(axis=1), history['ts'][at_low.argmax(axis=1)] if len(snaps) else np.nan, np.nan)
+    return history
+
+# inserts snapshot into history in timestamp order, new parts get a row
+# returns False if history already has snapshot with timestamp
+def add_history_prices(history, ts, prices):
+    with history['lock']:
+        old_ts, old_prices, old_rows = history['ts'], history['prices'], history['rows']
+        if (old_ts == ts).any(): return False
+
+        rows = dict(old_rows)
+        for pn in prices: rows.setdefault(normalize_pn(pn), len(rows))
+        col = int(np.searchsorted(old_ts, ts))
+        matrix = np.full((len(rows), len(old_ts)+1), np.nan, dtype=np.float32)
+        matrix[:len(old_rows), :col]   = old_prices[:, :col]
+        matrix[:len(old_rows), col+1:] = old_prices[:, col:]
+        matrix[[rows[normalize_pn(pn)] for pn in prices], col] = list(prices.values())
+
+        # update lowest and highest prices with new column only
+        new_rows = len(rows)-len(old_rows)
+        low    = np.append(history['low'],    np.full(new_rows, np.nan, dtype=np.float32))
+        low_ts = np.append(history['low ts'], np.full(new_rows, np.nan))
+        high   = np.append(history['high'],   np.full(new_rows, np.nan, dtype=np.float32))
+        column = matrix[:, col]
+        valid  = column > 0
+        lower  = valid & ~(column >= low) # also true if no low yet
+        # snapshots may be inserted before existing ones
+        earlier = valid & (column == low) & (ts < low_ts)
+
+        history['ts']     = np.insert(old_ts, col, ts)
+        history['prices'] = matrix
+        history['rows']   = rows
+        history['low ts'] = np.where(lower | earlier, ts, low_ts)
+        history['low']    = np.where(lower, column, low)
+        history['high']   = np.fmax(high, np.where(valid, column, np.nan))
+    return True
+
+def add_history_snapshot(history, db):
+    return add_history_prices(history, *price_snapshot(db))
+
+# returns np.array([history row or -1, ...]) per part ordinal of db index
+# cached in index until history gains rows
+def get_index_history_rows(index, history):
+    with history['lock']:
+        rows = history['rows']
+    cached = index.get('history rows')
+    if cached is None or cached[0] is not rows:
+        cached = (rows, np.array([rows.get(normalize_pn(part['part number']), -1) for brand, prod, part in index['parts']], dtype=np.intp))
+        index['history rows'] = cached
+    return cached[1]
+
+# returns np.array([ordinal, ...]) of parts matching search query, all parts if query is empty
+# None if query has no valid terms
+def search_ords(index, query):
+    if not query: return np.arange(len(index['parts']))
+    plan = compile_query(normalize_query(query), index['info_keys'], index['num_spec_keys'])
+    for msg in plan.ignored: print(msg)
+    if not (plan.qs or plan.expr): return None
+    ords, scores = plan_ords(index, plan)
+    return ords
+
+# returns indices of the k smallest keys in ascending order (ties in index order), all if k is None
+# only the selected k keys are sorted
+def top_k(keys, k=None):
+    if k and k < len(keys):
+        idx = np.sort(np.argpartition(keys, k-1)[:k])
+        return idx[np.argsort(keys[idx], kind='stable')]
+    return np.argsort(keys, kind='stable')
+
+# parts whose current price is within DEALS_MAX_ABOVE_LOW of their lowest recorded price
+# and lower than their highest, optionally only parts matching search query
+#deals = [
+#    (prod, part_db, current price, lowest price, lowest price timestamp, highest price),
+#    ...
+#] # largest drop from highest price first
+# returns (deals, total deals count, error)
+def get_deals(db, history, query='', max_results=None):
+    index = get_index(db)
+    ords = search_ords(index, query)
+    if ords is None: return [], 0, True
+
+    rows = get_index_history_rows(index, history)
+    with history['lock']:
+        low, low_ts, high = history['low'], history['low ts'], history['high']
+    prices, present = index['num_specs']['price']
+    ords = ords[present[ords] & (rows[ords] >= 0)]
+    current = prices[ords]
+    ords_low, ords_high = low[rows[ords]], high[rows[ords]]
+    # half a cent for float32 history prices
+    is_deal = (current <= ords_low*(1+DEALS_MAX_ABOVE_LOW)+0.005) & (current < ords_high-0.005)
+    ords = ords[is_deal]
+    drops = 1-current[is_deal]/ords_high[is_deal]
+    total = len(ords)
+    ords = ords[top_k(-drops, max_results)]
+
+    deals = []
+    for n in ords.tolist():
+        brand, prod, part = index['parts'][n]
+        row = rows[n]
+        deals.append((prod, part, float(prices[n]), round(float(low[row]), 2), float(low_ts[row]), round(float(high[row]), 2)))
+    return deals, total, False
+
+# returns window in days of '7', '7d', '2w', '3m' or '1y', None if not a window
+def parse_window(window):
+    m = re.fullmatch(r'(\d+)([dwmy]?)', window.strip().lower())
+    if not m or not int(m.group(1)): return None
+    return int(m.group(1)) * {'': 1, 'd': 1, 'w': 7, 'm': 30, 'y': 365}[m.group(2)]
+
+# price changes of parts matching search query between current db and the last history snapshot
+# at least days before the latest one (or the first snapshot of parts added since)
+#movers = {
+#    'parts': [(prod, part_db, old price, current price, change %), ...], # largest absolute change first
+#    'lines': [(prod, changed parts, parts, mean change %), ...],       # product lines with changed parts
+#    'total': number of parts with changed price,
+#    'since': timestamp of snapshot prices are compared to,
+#}
+# returns (movers, error)
+def get_movers(db, history, days=None, query='', max_results=None):
+    if days is None: days = MOVERS_WINDOW_DAYS
+    index = get_index(db)
+    ords = search_ords(index, query)
+    if ords is None: return None, True
+
+    rows = get_index_history_rows(index, history)
+    with history['lock']:
+        ts, matrix = history['ts'], history['prices']
+    if not len(ts): return {'parts': [], 'lines': [], 'total': 0, 'since': None}, False
+    start = max(0, int(np.searchsorted(ts, ts[-1] - days*86400, side='right')) - 1)
+
+    prices, present = index['num_specs']['price']
+    ords = ords[present[ords] & (rows[ords] >= 0)]
+    # first price of each part in window, nan rows are parts only in current db
+    window = matrix[rows[ords], start:]
+    valid = ~np.isnan(window)
+    first = np.argmax(valid, axis=1)
+    old = np.round(window[np.arange(len(ords)), first].astype(np.float64), 2)
+    has_old = valid.any(axis=1) & (old > 0)
+    ords, old = ords[has_old], old[has_old]
+    changes = (prices[ords] - old) / old * 100
+    is_changed = np.abs(prices[ords] - old) > 0.005
+
+    # mean change per product line over all its matching parts
+    prods, prod_ids = np.unique([index['parts'][n][1] for n in ords.tolist()], return_inverse=True)
+    counts = np.bincount(prod_ids, minlength=len(prods))
+    changed_counts = np.bincount(prod_ids, weights=is_changed, minlength=len(prods))
+    means = np.bincount(prod_ids, weights=changes, minlength=len(prods)) / np.maximum(counts, 1)
+    line_ids = np.flatnonzero(changed_counts)
+    line_ids = line_ids[top_k(-np.abs(means[line_ids]), max_results)]
+
+    changed = np.flatnonzero(is_changed)
+    total = len(changed)
+    changed = changed[top_k(-np.abs(changes[changed]), max_results)]
+    movers = {
+        'parts': [],
+        'lines': [(str(prods[i]), int(changed_counts[i]), int(counts[i]), float(means[i])) for i in line_ids.tolist()],
+        'total': total,
+        'since': float(ts[start]),
+    }
+    for i in changed.tolist():
+        brand, prod, part = index['parts'][ords[i]]
+        movers['parts'].append((prod, part, float(old[i]), float(prices[ords[i]]), float(changes[i])))
+    return movers, False
+
+# returns (np.array([timestamp, ...]), np.array([price or nan, ...])) or (None, None) if part not in history
+def get_history_prices(history, pn):
+    with history['lock']:
+        ts, prices, rows = history['ts'], history['prices'], history['rows']
+    row = rows.get(normalize_pn(pn))
+    if row is None: return None, None
+    return ts, prices[row]
+
+# returns (np.array([timestamp, ...]), np.array([[price or nan, ...], ...]) part numbers x snapshots)
+# rows of part numbers not in history are nan
+def get_history_rows(history, pns):
+    with history['lock']:
+        ts, prices, rows = history['ts'], history['prices'], history['rows']
+    ret = np.full((len(pns), len(ts)), np.nan, dtype=np.float32)
+    found = [(i, rows[normalize_pn(pn)]) for i, pn in enumerate(pns) if normalize_pn(pn) in rows]
+    if found:
+        ret_rows, history_rows = zip(*found)
+        ret[list(ret_rows)] = prices[list(history_rows)]
+    return ts, ret
+
+# returns [(dt:datetime, price:float, unavailable:bool) ...] like get_history()
+def get_history_data(history, pn):
+    ts, prices = get_history_prices(history, pn)
+    if ts is None: return []
+    # float32 prices rounded back to cents
+    return [(datetime.utcfromtimestamp(t), -100 if np.isnan(p) else round(p, 2), False) for t, p in zip(ts.tolist(), prices.tolist())]
 
 # takes (data, part) return value from get_history()
 # returns binary stream of plot image
+# uses Figure directly instead of pyplot so plots can be rendered in any thread or process
 def plot_history(data, part):
     unav_alpha = 0.6
 
@@ -477,15 +1562,18 @@ def plot_history(data, part):
         y_masked_unav = np.ma.masked_where(a == 1.0, y_masked)
         y_masked_av = np.ma.masked_where(a < 1.0, y_masked)
 
-        plt.rcParams['font.size'] = 12
-        fig = plt.figure(figsize=(8,5))
-        ax = plt.axes()
+        font_size = 12
+        fig = Figure(figsize=(8,5))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        ax.tick_params(labelsize=font_size)
 
         locator = mdates.AutoDateLocator()
         locator.intervald[DAILY] = [round((x[-1]-x[0]).days/15)]
         formatter = mdates.ConciseDateFormatter(locator)
         ax.xaxis.set_major_locator(locator)
         ax.xaxis.set_major_formatter(formatter)
+        ax.xaxis.get_offset_text().set_fontsize(font_size)
 
         ax.set_ylim(bottom=0)
         ylim = round(max(y))+200-(round(max(y))%100)
@@ -498,37 +1586,206 @@ def plot_history(data, part):
                     or all([abs(y[i-n]-y[i]) > ylim/20 for n in range(1, 10)])
                 )
             ):
-                plt.text(x=x[i], y=y[i]-ylim/5/3, s=f'{curr}{round(y[i])}', **{'fontweight': 'bold', 'alpha': a[i]})
+                ax.text(x=x[i], y=y[i]-ylim/5/3, s=f'{curr}{round(y[i])}', **{'fontweight': 'bold', 'alpha': a[i], 'fontsize': font_size})
 
-        plt.title(part['name'])
-        plt.scatter(x, y, alpha=a)
-        plt.plot(x, y_masked_av)
-        plt.plot(x, y_masked_unav, 'C0--', alpha=unav_alpha)
-        plt.grid(axis='x')
+        ax.set_title(part['name'], fontsize=font_size*1.2)
+        ax.scatter(x, y, alpha=a)
+        ax.plot(x, y_masked_av)
+        ax.plot(x, y_masked_unav, 'C0--', alpha=unav_alpha)
+        ax.grid(axis='x')
 
         bytes = io.BytesIO()
-        plt.savefig(bytes, format='png', bbox_inches='tight', dpi=100)
-        plt.close()
+        fig.savefig(bytes, format='png', bbox_inches='tight', dpi=100)
 
         return bytes
     else: return None
 
+# unicode sparkline of prices with at most width characters, missing prices (<= 0) are blank
+# consecutive snapshots are bucketed by their lowest price to fit width
+def sparkline(prices, width=None):
+    if not width: width = SPARKLINE_WIDTH
+    y = np.asarray(prices, dtype=np.float64)
+    if not len(y) or not (y > 0).any(): return ''
+    buckets = min(width, len(y))
+    lows = np.minimum.reduceat(np.where(y > 0, y, np.inf), (np.arange(buckets)*len(y))//buckets)
+    present = np.isfinite(lows)
+    lo, hi = lows[present].min(), lows[present].max()
+    levels = np.zeros(buckets, dtype=int)
+    if hi > lo: levels[present] = np.round((lows[present]-lo)/(hi-lo)*(len(SPARKLINE_CHARS)-1))
+    else:       levels[present] = len(SPARKLINE_CHARS)//2
+    return ''.join([SPARKLINE_CHARS[l] if p else ' ' for l, p in zip(levels, present)])
+
+# takes (data, part) return value from get_history()
+# returns text summary of price history with sparkline, no plot needed
+def format_history_text(data, part):
+    curr = part['num_specs']['price'][1]
+    x = [d[0] for d in data]
+    y = np.array([d[1] for d in data], dtype=np.float64)
+    present = y > 0
+    if not present.any(): return '[no prices recorded]\n'
+
+    low  = int(np.argmin(np.where(present, y, np.inf)))
+    high = int(np.argmax(np.where(present, y, -np.inf)))
+    contents  = f'{sparkline(y)}\n'
+    contents += f'{x[0].strftime("%b %d %Y")} - {x[-1].strftime("%b %d %Y")} ({len(y)} snapshots)\n\n'
+    if present[-1]:
+        contents += f'{"current":8} {curr}{y[-1]:.2f}\n'
+    else:
+        contents += f'{"current":8} not listed\n'
+    contents += f'{"low":8} {curr}{y[low]:.2f} on {x[low].strftime("%b %d %Y")}\n'
+    contents += f'{"high":8} {curr}{y[high]:.2f} on {x[high].strftime("%b %d %Y")}\n'
+    if present[-1]:
+        if y[-1] <= y[low]: contents += 'currently at all-time low\n'
+        else:               contents += f'{(y[-1]/y[low]-1)*100:.1f}% above all-time low\n'
+    return contents
+
+# takes (dates, prices, parts) return value from get_histories()
+# missing prices (-100 or nan) of all parts are masked at once
+# returns binary stream of plot image with one series per part
+def plot_histories(dates, prices, parts):
+    font_size = 12
+    x = np.array(dates)
+    y = np.ma.masked_where(~(np.asarray(prices, dtype=np.float64) > 0), prices)
+    curr = parts[0]['num_specs']['price'][1]
+
+    fig = Figure(figsize=(8,5))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.tick_params(labelsize=font_size)
+
+    locator = mdates.AutoDateLocator()
+    locator.intervald[DAILY] = [max(round((x[-1]-x[0]).days/15), 1)]
+    formatter = mdates.ConciseDateFormatter(locator)
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(formatter)
+    ax.xaxis.get_offset_text().set_fontsize(font_size)
+
+    ax.set_ylim(bottom=0)
+    ymax = y.max() if y.count() else 0
+    ylim = round(ymax)+200-(round(ymax)%100)
+    ax.set_yticks(np.arange(0, ylim+1, ylim/5))
+    ax.yaxis.set_major_formatter(curr+'{x:1.0f}')
+
+    for i, part in enumerate(parts):
+        latest = y[i].compressed()
+        label = f'{part["part number"]} ({curr}{round(latest[-1])})' if len(latest) else part['part number']
+        ax.plot(x, y[i], marker='o', markersize=4, label=label)
+
+    ax.set_title('Price history', fontsize=font_size*1.2)
+    ax.legend(fontsize=font_size*0.8, loc='lower left')
+    ax.grid(axis='x')
+
+    bytes = io.BytesIO()
+    fig.savefig(bytes, format='png', bbox_inches='tight', dpi=100)
+    return bytes
+
+def plot_histories_png(dates, prices, parts):
+    return plot_histories(dates, prices, parts).getvalue()
+
+# plot_history() as png bytes, for rendering in a process pool
+def plot_history_png(data, part):
+    bytes = plot_history(data, part)
+    return bytes.getvalue() if bytes else None
+
+# history plot pngs cached per (region, part number, latest snapshot timestamp)
+# least recently used pngs past PLOT_CACHE_MAX_BYTES are spilled to disk if a spill dir is set
+# spilled pngs past PLOT_CACHE_MAX_SPILL_BYTES are deleted
+def plot_cache_key(region, pn, ts):
+    return (region, normalize_pn(pn), ts)
+
+# spills into PLOT_CACHE_SPILL_SUBDIR of spill_dir and removes pngs spilled there by a previous run
+# other files are left alone in case spill_dir is shared
+def init_plot_cache(spill_dir):
+    spill_dir = os.path.join(spill_dir, PLOT_CACHE_SPILL_SUBDIR)
+    if not os.path.exists(spill_dir): os.makedirs(spill_dir)
+    for f in os.scandir(spill_dir):
+        if PLOT_SPILL_RE.match(f.name) and f.is_file(): os.remove(f.path)
+    PLOT_CACHE['spill dir'] = spill_dir
+
+# returns png bytes or None
+def get_cached_plot(key):
+    with PLOT_CACHE['lock']:
+        entries = PLOT_CACHE['entries']
+        if key in entries:
+            PLOT_CACHE['hits'] += 1
+            entries.move_to_end(key)
+            return entries[key]
+        if key in PLOT_CACHE['spilled']:
+            path, size = PLOT_CACHE['spilled'].pop(key)
+            PLOT_CACHE['spill bytes'] -= size
+            try:
+                with open(path, 'rb') as f: png = f.read()
+                os.remove(path)
+            except OSError: png = None
+            if png is not None:
+                PLOT_CACHE['hits'] += 1
+                add_plot_entry(key, png)
+                return png
+        PLOT_CACHE['misses'] += 1
+    return None
+
+def has_cached_plot(key):
+    with PLOT_CACHE['lock']:
+        return key in PLOT_CACHE['entries'] or key in PLOT_CACHE['spilled']
+
+def put_cached_plot(key, png):
+    if len(png) > PLOT_CACHE_MAX_BYTES: return
+    with PLOT_CACHE['lock']:
+        add_plot_entry(key, png)
+
+# requires PLOT_CACHE['lock']
+def add_plot_entry(key, png):
+    entries = PLOT_CACHE['entries']
+    if key in entries: return
+    entries[key] = png
+    PLOT_CACHE['bytes'] += len(png)
+    while PLOT_CACHE['bytes'] > PLOT_CACHE_MAX_BYTES:
+        evicted_key, evicted = entries.popitem(last=False)
+        PLOT_CACHE['bytes'] -= len(evicted)
+        if PLOT_CACHE['spill dir']: spill_plot(evicted_key, evicted)
+
+# requires PLOT_CACHE['lock']
+def spill_plot(key, png):
+    region, pn, ts = key
+    name = re.sub(r'[^\w-]', '_', pn)
+    path = f'{PLOT_CACHE["spill dir"]}/{region}_{name}_{int(ts)}.png' # matches PLOT_SPILL_RE
+    try:
+        with open(path, 'wb') as f: f.write(png)
+    except OSError: return
+    spilled = PLOT_CACHE['spilled']
+    spilled[key] = (path, len(png))
+    PLOT_CACHE['spill bytes'] += len(png)
+    while PLOT_CACHE['spill bytes'] > PLOT_CACHE_MAX_SPILL_BYTES:
+        _, (evicted_path, size) = spilled.popitem(last=False)
+        PLOT_CACHE['spill bytes'] -= size
+        if os.path.exists(evicted_path): os.remove(evicted_path)
+
+def get_plot_cache_stats():
+    total = PLOT_CACHE['hits'] + PLOT_CACHE['misses']
+    return {
+        'entries':     len(PLOT_CACHE['entries']),
+        'bytes':       PLOT_CACHE['bytes'],
+        'spilled':     len(PLOT_CACHE['spilled']),
+        'spill bytes': PLOT_CACHE['spill bytes'],
+        'hits':        PLOT_CACHE['hits'],
+        'misses':      PLOT_CACHE['misses'],
+        'hit rate':    PLOT_CACHE['hits']/total if total else 0.0,
+    }
+
 def get_region_emoji(region_short):
     if region_short in REGION_EMOJIS:
         return REGION_EMOJIS[region_short]
     else:
         return None
 
-def get_status(db, backup_dir=None):
+# backup_catalog from snapshots.new_catalog(), status is rendered without directory I/O
+def get_status(db, backup_catalog=None):
     string = ''
 
-    backup_tss = []
-    if backup_dir:
-        for f in os.scandir(backup_dir):
-            if f.name.startswith(f'db_{db["metadata"]["short region"]}_') and f.name.endswith('.json'):
-                # use mtime instead of json timestamp (much faster)
-                backup_tss.append(f.stat().st_mtime)
-    backup_tss = sorted(backup_tss)
+    backups = None
+    if backup_catalog:
+        # use snapshot day from filename instead of json timestamp (much faster)
+        backups = snapshots.get_catalog_summary(backup_catalog, db['metadata']['short region'])
 
     emoji = get_region_emoji(db['metadata']['short region'])
     if emoji: string += f' {emoji}'
@@ -536,9 +1793,9 @@ def get_status(db, backup_dir=None):
 
     string += f'**{db["metadata"]["total"]}** products total across **{len(db["data"].keys())}** series\n'
 
-    if backup_tss:
-        dt = datetime.utcfromtimestamp(backup_tss[0])
-        string += f'**{len(backup_tss)}** historical databases saved since {dt.strftime("%b %d %Y")} ({pretty_duration((datetime.utcnow() - dt).total_seconds())} ago)\n'
+    if backups and backups['count']:
+        dt = datetime.utcfromtimestamp(backups['first'])
+        string += f'**{backups["count"]}** historical databases saved since {dt.strftime("%b %d %Y")} ({pretty_duration((datetime.utcnow() - dt).total_seconds())} ago, {pretty_size(backups["bytes"])})\n'
     else: string += f'No historical databases saved\n'
 
     return string
@@ -564,6 +1821,8 @@ def get_dbs(dir):
             with open(f'{dir}/{filename}', 'r') as f:
                 js = f.read()
                 db = json.loads(js)
+                db['index'] = build_index(db)
+                invalidate_search_cache(db['metadata']['short region'])
                 print(f'Loaded \'{dir}/{filename}\'')
                 dbs[db['metadata']['short region']] = db
     return dbs
@@ -580,6 +1839,8 @@ def get_usage_str(prefixes):
         f'  {"st|status"     :14}    {COMMAND_BRIEFS["status"]}\n'
         f'  {"sr|setregion"  :14}    {COMMAND_BRIEFS["setregion"]}\n'
         f'  {"ps|psref"      :14}    {COMMAND_BRIEFS["psref"]}\n'
+        f'  {"a|all s|search query[, query, ...]"}\n'
+        f'  {" "             :14}    {COMMAND_BRIEFS["all"]}\n'
         f'\n'
         f'commands with region:\n'
         f'  {"st|status"     :14}    {COMMAND_BRIEFS["reg_status"]}\n'
@@ -590,6 +1851,14 @@ def get_usage_str(prefixes):
         f'  {"sp|specs prodnum [spec[, spec, ...]]"}\n'
         f'  {" "             :14}    {COMMAND_BRIEFS["reg_specs"]}\n'
         f'  {"hi|history"    :14}    {COMMAND_BRIEFS["reg_history"]}\n'
+        f'  {"cp|compare prodnum prodnum [...] [spec[, spec, ...]]"}\n'
+        f'  {" "             :14}    {COMMAND_BRIEFS["reg_compare"]}\n'
+        f'  {"dl|deals [query[, query, ...]]"}\n'
+        f'  {" "             :14}    {COMMAND_BRIEFS["reg_deals"]}\n'
+        f'  {"mv|movers [window] [query[, query, ...]]"}\n'
+        f'  {" "             :14}    {COMMAND_BRIEFS["reg_movers"]}\n'
+        f'  {"ex|explain query[, query, ...]"}\n'
+        f'  {" "             :14}    {COMMAND_BRIEFS["reg_explain"]}\n'
         f'\n'
         f'examples:\n'
         f'  "{prefix} help search"\n'
@@ -599,9 +1868,13 @@ def get_usage_str(prefixes):
         f'  "{prefix} us specs 20TK001EUS"\n'
         f'  "{prefix} us specs 20TK001EUS price, display, memory"\n'
         f'  "{prefix} us history 20TK001EUS"\n'
+        f'  "{prefix} us compare 20TK001EUS 20TK001RUS price, display, memory"\n'
+        f'  "{prefix} us deals thinkpad, memory>=16"\n'
+        f'  "{prefix} us movers 30d thinkpad"\n'
         f'  "{prefix} setregion us", then "{prefix} history 20TK001EUS"\n'
         f'  "{prefix} psref 20XW004AUS"\n'
         f'  "{prefix} psref 20XW004AUS processor, display, memory"\n'
+        f'  "{prefix} all search x1e, price<=1400"\n'
     )
 
 def get_command_descr(cmd, prefixes):
@@ -654,6 +1927,17 @@ def get_command_descr(cmd, prefixes):
             f'  "{prefixes[0]} psref 20XW004AUS"\n'
             f'  "{prefixes[0]} psref 20XW004AUS processor, display, memory"\n'
         )
+    elif cmd == 'all':
+        ret_str = (
+            f'usage: {"|".join(prefixes)} all search [query[, query, ...]]\n'
+            f'       {"|".join(prefixes)} a   s      [query[, query, ...]]\n'
+            f'\n'
+            f'{COMMAND_BRIEFS["all"]}\n'
+            f'results are grouped by region. see \'help search\' for valid queries.\n'
+            f'\n'
+            f'example:\n'
+            f'  "{prefixes[0]} all search x1e, price<=1400"\n'
+        )
     elif cmd == 'reg_status':
         ret_str = COMMAND_BRIEFS['reg_status'] # inaccessible
     elif cmd == 'reg_listspecs':
@@ -679,16 +1963,41 @@ def get_command_descr(cmd, prefixes):
             f'\n'
             f'valid queries:\n'
             f'  term            searches for term in any field\n'
+            f'  ~term           searches for words similar to term in product names\n'
+            f'                  tolerates typos, e.g. \'~thinkapd x1 carbn\'\n'
             f'  spec:[term]     searches for term in spec\n'
+            f'  pn:[prefix]*    searches for part numbers starting with prefix, e.g. \'pn:20xw*\'\n'
+            f'                  also works with product, e.g. \'product:20xw*\'\n'
             f'                  leave term blank to always list spec in results\n'
             f'                  use \'listspecs\' region command to view valid specs\n'
             f'  num_spec<[num]  searches for num_spec that satisfies the condition \'< num\'\n'
             f'                  leave num blank to always list num_spec in results\n'
             f'                  valid operators are <,<=,==,!=,=>,>\n'
             f'                  use \'listspecs\' region command to view valid num_specs.\n'
+            f'  a | b           matches either query a or query b\n'
+            f'  !query, -query  excludes results matching query\n'
+            f'                  a lone \'-\' or \'!\' with no query after it is searched as a term\n'
+            f'  (a, b)          groups queries, e.g. \'(x1, 16gb) | p1\'\n'
+            f'  sort:[-]spec    sorts results by num_spec spec, descending if prefixed with \'-\'\n'
+            f'  sort:relevance  ranks results by how well they match the words of terms\n'
+            f'                  terms no longer need to match exactly, e.g. \'x1 carbon gen 9, sort:rel\'\n'
+            f'  limit:[num]     lists only the first num results\n'
             f'\n'
             f'example:\n'
             f'  "{prefixes[0]} us search x1e, price<=1400, display:fhd"\n'
+            f'  "{prefixes[0]} us search thinkpad, sort:price, limit:10"\n'
+        )
+    elif cmd == 'reg_explain':
+        ret_str = (
+            f'usage: {"|".join(prefixes)} [region] explain [query[, query, ...]]\n'
+            f'       {"|".join(prefixes)} [region] ex      [query[, query, ...]]\n'
+            f'\n'
+            f'{COMMAND_BRIEFS["reg_explain"]}\n'
+            f'lists ignored queries, parts remaining after each query and time spent per stage.\n'
+            f'see \'help search\' for valid queries.\n'
+            f'\n'
+            f'example:\n'
+            f'  "{prefixes[0]} us explain x1e, price<=1400, display:fhd"\n'
         )
     elif cmd == 'reg_specs':
         ret_str = (
@@ -703,15 +2012,64 @@ def get_command_descr(cmd, prefixes):
             f'  "{prefixes[0]} us specs 20TK001EUS"\n'
             f'  "{prefixes[0]} us specs 20TK001EUS price, display, memory"\n'
         )
+    elif cmd == 'reg_compare':
+        ret_str = (
+            f'usage: {"|".join(prefixes)} [region] compare [prodnum prodnum ...] [spec[, spec, ...]]\n'
+            f'       {"|".join(prefixes)} [region] cp      [prodnum prodnum ...] [spec[, spec, ...]]\n'
+            f'\n'
+            f'{COMMAND_BRIEFS["reg_compare"]}\n'
+            f'part numbers can be separated by spaces or commas.\n'
+            f'specs that differ between products are marked with \'*\'.\n'
+            f'if specs are given, compares only the given comma-separated specs.\n'
+            f'use \'listspecs\' to view valid specs.\n'
+            f'\n'
+            f'examples:\n'
+            f'  "{prefixes[0]} us compare 20TK001EUS 20TK001RUS"\n'
+            f'  "{prefixes[0]} us compare 20TK001EUS 20TK001RUS price, display, memory"\n'
+        )
+    elif cmd == 'reg_deals':
+        ret_str = (
+            f'usage: {"|".join(prefixes)} [region] deals [query[, query, ...]]\n'
+            f'       {"|".join(prefixes)} [region] dl    [query[, query, ...]]\n'
+            f'\n'
+            f'{COMMAND_BRIEFS["reg_deals"]}\n'
+            f'lists products priced within {DEALS_MAX_ABOVE_LOW*100:g}% of their lowest recorded price\n'
+            f'that were more expensive before, largest price drop first.\n'
+            f'if a query is given, only products matching it are listed. see \'help search\' for valid queries.\n'
+            f'\n'
+            f'examples:\n'
+            f'  "{prefixes[0]} us deals"\n'
+            f'  "{prefixes[0]} us deals thinkpad, memory>=16"\n'
+        )
+    elif cmd == 'reg_movers':
+        ret_str = (
+            f'usage: {"|".join(prefixes)} [region] movers [window] [query[, query, ...]]\n'
+            f'       {"|".join(prefixes)} [region] mv     [window] [query[, query, ...]]\n'
+            f'\n'
+            f'{COMMAND_BRIEFS["reg_movers"]}\n'
+            f'compares current prices to the last snapshot at least window before the latest one\n'
+            f'(or the first snapshot of products added since), largest changes first.\n'
+            f'window is a number of days, weeks, months or years, e.g. 7, 7d, 2w, 3m, 1y (default {MOVERS_WINDOW_DAYS}d).\n'
+            f'product lines are listed with the average change of their products.\n'
+            f'if a query is given, only products matching it are compared. see \'help search\' for valid queries.\n'
+            f'\n'
+            f'examples:\n'
+            f'  "{prefixes[0]} us movers"\n'
+            f'  "{prefixes[0]} us movers 30d thinkpad, memory>=16"\n'
+        )
     elif cmd == 'reg_history':
         ret_str = (
-            f'usage: {"|".join(prefixes)} [region] history [prodnum]\n'
-            f'       {"|".join(prefixes)} [region] hi      [prodnum]\n'
+            f'usage: {"|".join(prefixes)} [region] history [-t|--text] [prodnum ...]\n'
+            f'       {"|".join(prefixes)} [region] hi      [-t|--text] [prodnum ...]\n'
             f'\n'
             f'{COMMAND_BRIEFS["reg_history"]}\n',
+            f'multiple product numbers are plotted together.\n'
+            f'use --text for a text summary instead of a plot.\n'
             f'\n'
-            f'example:\n'
+            f'examples:\n'
             f'  "{prefixes[0]} us history 20TK001EUS"\n'
+            f'  "{prefixes[0]} us history --text 20TK001EUS"\n'
+            f'  "{prefixes[0]} us history 20TK001EUS 20TK001RUS"\n'
         )
     else:
         ret_str = ''
@@ -722,12 +2080,71 @@ COMMAND_BRIEFS = {
     'setregion':     'set/view/clear user region for region commands',
     'listregions':   'list all available regions',
     'status':        'display status for all available databases',
+    'all':           'search all available regions at once',
     'reg_status':    'display region\'s database status',
     'reg_changes':   'show changes compared to previous update',
     'reg_listspecs': 'list valid specs and num_specs',
     'reg_search':    'search for products with queries separated by commas',
+    'reg_explain':   'show how a search query is evaluated',
     'reg_specs':     'list specs for a given product number',
     'reg_history':   'show price history for a given product number',
+    'reg_compare':   'compare specs of products side by side',
+    'reg_deals':     'list products at or near their lowest price',
+    'reg_movers':    'list largest price changes over a time window',
+}
+
+NUM_SPEC_OPS = {
+    '<':  operator.lt,
+    '<=': operator.le,
+    '=':  operator.eq,
+    '==': operator.eq,
+    '>=': operator.ge,
+    '>':  operator.gt,
+    '!=': operator.ne,
+}
+
+QueryPlan = namedtuple('QueryPlan', ['qs', 'ignored', 'sort', 'limit', 'expr'])
+
+PREFIX_SPECS = ['part number', 'product']
+COMPARE_NOWRAP_WIDTH = 16 # compare values up to this long (prices, memory, weight) are never wrapped
+GENERIC_SKIP_SPECS = frozenset(['summary']) # only matched by spec:term, not by generic terms
+COMPLETE_MAX_RESULTS = 25
+
+SEARCH_SCAN_MAX = 256 # max candidates checked directly instead of by index lookup
+FUZZY_MIN_SIMILARITY = 0.5
+FUZZY_WORDS_CACHE_MAX = 4096
+BM25_K1 = 1.2
+BM25_B  = 0.75
+
+SEARCH_CACHE_MAX_ENTRIES = 512
+SEARCH_CACHE_MAX_BYTES   = 32*1024*1024
+SEARCH_CACHE = {
+    'entries': OrderedDict(), # { (region, query, timestamp, max_results): ((results, total, error), size), ... }
+    'bytes':   0,
+    'hits':    0,
+    'misses':  0,
+    'lock':    threading.Lock(),
+}
+
+DEALS_MAX_ABOVE_LOW = 0.02 # current price at most 2% above lowest price
+MOVERS_WINDOW_DAYS = 7
+
+SPARKLINE_CHARS = '▁▂▃▄▅▆▇█'
+SPARKLINE_WIDTH = 40
+
+PLOT_CACHE_MAX_BYTES       = 16*1024*1024
+PLOT_CACHE_MAX_SPILL_BYTES = 256*1024*1024
+PLOT_CACHE_SPILL_SUBDIR    = 'lelnovo_plots'
+PLOT_SPILL_RE              = re.compile(r'[\w-]+_[\w-]+_\d+\.png$') # region_pn_ts.png
+PLOT_CACHE = {
+    'entries':     OrderedDict(), # { (region, pn, timestamp): png bytes, ... }
+    'bytes':       0,
+    'spilled':     OrderedDict(), # { (region, pn, timestamp): (path, size), ... }
+    'spill bytes': 0,
+    'spill dir':   None,
+    'hits':        0,
+    'misses':      0,
+    'lock':        threading.Lock(),
 }
 
 REGION_EMOJIS = {
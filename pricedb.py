@@ -0,0 +1,123 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+import snapshots
+
+# price history of every scraped db snapshot, one row per (region, part number, snapshot)
+#
+#snapshots = (region, ts)                 # every snapshot, parts missing from a snapshot have no price row
+#prices    = (region, pn, ts, price)      # pn is normalized (stripped, lowercase)
+#parts     = (region, pn, ts, part json)  # part from earliest snapshot containing it
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    region TEXT NOT NULL,
+    ts     REAL NOT NULL,
+    PRIMARY KEY (region, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS prices (
+    region TEXT NOT NULL,
+    pn     TEXT NOT NULL,
+    ts     REAL NOT NULL,
+    price  REAL NOT NULL,
+    PRIMARY KEY (region, pn, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS parts (
+    region TEXT NOT NULL,
+    pn     TEXT NOT NULL,
+    ts     REAL NOT NULL,
+    part   TEXT NOT NULL,
+    PRIMARY KEY (region, pn)
+) WITHOUT ROWID;
+'''
+
+def connect(path):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.executescript(SCHEMA)
+    return conn
+
+def normalize_pn(pn):
+    return pn.strip().lower()
+
+# adds snapshot of db to store, returns False if region already has snapshot with db's timestamp
+def add_snapshot(conn, db):
+    region = db['metadata']['short region']
+    ts     = db['metadata']['timestamp']
+    with conn:
+        cur = conn.execute('INSERT OR IGNORE INTO snapshots VALUES (?, ?)', (region, ts))
+        if not cur.rowcount: return False
+        conn.executemany(
+            'INSERT OR REPLACE INTO prices VALUES (?, ?, ?, ?)',
+            [(region, normalize_pn(pn), ts, price[0]) for pn, price in db['prices'].items()],
+        )
+        # keep part of earliest snapshot, snapshots may be added out of order
+        conn.executemany(
+            'INSERT INTO parts VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (region, pn) DO UPDATE SET ts = excluded.ts, part = excluded.part WHERE excluded.ts < parts.ts',
+            [(region, normalize_pn(part['part number']), ts, json.dumps(part))
+                for brand, prods in db['data'].items() for prod, parts in prods.items() for part in parts],
+        )
+    return True
+
+# returns same as lelnovo.get_history()
+# ([(dt:datetime, price:float, unavailable:bool) ...], part:dict)
+def get_history(conn, region, pn):
+    pn = normalize_pn(pn)
+    row = conn.execute('SELECT part FROM parts WHERE region = ? AND pn = ?', (region, pn)).fetchone()
+    if row is None: return [], None
+    rows = conn.execute(
+        'SELECT s.ts, p.price FROM snapshots s '
+        'LEFT JOIN prices p ON p.region = s.region AND p.pn = ? AND p.ts = s.ts '
+        'WHERE s.region = ? ORDER BY s.ts',
+        (pn, region),
+    ).fetchall()
+    data = [(datetime.utcfromtimestamp(ts), -100 if price is None else price, False) for ts, price in rows]
+    return data, json.loads(row[0])
+
+# returns [ts, ...] of region's snapshots in order
+def get_snapshots(conn, region):
+    return [ts for ts, in conn.execute('SELECT ts FROM snapshots WHERE region = ? ORDER BY ts', (region,))]
+
+# returns [(timestamp, { 'part number (normalized)': price, ... }), ...] of region's snapshots in order
+# for lelnovo.build_history()
+def get_price_snapshots(conn, region):
+    snaps = {ts: {} for ts in get_snapshots(conn, region)}
+    for pn, ts, price in conn.execute('SELECT pn, ts, price FROM prices WHERE region = ?', (region,)):
+        snaps[ts][pn] = price
+    return list(snaps.items())
+
+# back-fills store from every db_*.json in dirs (e.g. backup dir and current db dir)
+# returns number of snapshots added
+def import_dirs(conn, dirs, verbose=False):
+    added = 0
+    for dir in dirs:
+        for f in sorted(os.scandir(dir), key=lambda f: f.name):
+            if f.name.startswith('db_') and f.name.endswith('.json') and f.is_file():
+                # keyframes and current dbs are read as is, deltas are applied to their keyframe
+                db = snapshots.load_snapshot(f.path)
+                if add_snapshot(conn, db):
+                    added += 1
+                    if verbose: print(f'Imported \'{f.path}\'')
+                elif verbose: print(f'Skipped \'{f.path}\' (already imported)')
+    return added
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='back-fill price history store from db json files')
+    parser.add_argument('store', help='sqlite price history file, created if missing')
+    parser.add_argument('dirs', nargs='+', help='directories with db_*.json files, e.g. dbs/backup dbs')
+    parser.add_argument('-q', '--quiet', action='store_true')
+    args = parser.parse_args()
+
+    for dir in args.dirs:
+        if not os.path.isdir(dir): sys.exit(f'\'{dir}\' is not a directory')
+
+    start = time.time()
+    conn = connect(args.store)
+    added = import_dirs(conn, args.dirs, verbose=not args.quiet)
+    conn.execute('ANALYZE')
+    conn.close()
+    print(f'Imported {added} snapshots into \'{args.store}\' in {time.time()-start:.1f}s')
@@ -7,7 +7,7 @@ import json
 import math
 import time
 import multiprocessing
-import os, shutil
+import os
 from bs4 import BeautifulSoup
 from itertools import repeat
 from collections import namedtuple
@@ -15,6 +15,9 @@ from datetime import datetime
 from html2text import html2text
 from pprint import pprint, pformat
 
+import pricedb
+import snapshots
+
 def try_request(s, url, wait_s=1, tries=3):
     global FORBIDDEN_COUNT
 
@@ -615,6 +618,7 @@ if __name__ == '__main__':
     parser.add_argument('-pw', '--password')
     parser.add_argument('-p', '--print_progress', action='store_true')
     parser.add_argument('-l', '--print_live_progress', action='store_true')
+    parser.add_argument('-H', '--history_db', help='sqlite price history store to append prices to')
     args = parser.parse_args()
 
     BASE_URL = f'https://www.lenovo.com/{args.region}'
@@ -850,14 +854,20 @@ if __name__ == '__main__':
             print(f'Wrote temp-banned db to \'./{filename}\' on {time.strftime("%c")}')
     else:
         if not os.path.exists(DB_DIR): os.makedirs(DB_DIR)
-        # backup old json file
+        # backup old db as keyframe or delta
         if db['changes']:
             if not os.path.exists(f'{DB_DIR}/backup'): os.makedirs(f'{DB_DIR}/backup')
-            new_filename = f'db_{args.region_short}_{datetime.fromtimestamp(db_old["metadata"]["timestamp"]).strftime("%y%m%d")}.json'
-            shutil.copyfile(f'{DB_DIR}/{DB_FILENAME}', f'{DB_DIR}/backup/{new_filename}')
-            print(f'Backed up \'{DB_DIR}/{DB_FILENAME}\' to \'{DB_DIR}/backup/{new_filename}\'')
+            path = snapshots.write_snapshot(f'{DB_DIR}/backup', db_old)
+            print(f'Backed up \'{DB_DIR}/{DB_FILENAME}\' to \'{path}\'')
 
         # write new json file
         with open(f'{DB_DIR}/{DB_FILENAME}', 'w') as f:
             json.dump(db, f)
             print(f'Wrote to \'{DB_DIR}/{DB_FILENAME}\' on {time.strftime("%c")}')
+
+        # append prices to history store
+        if args.history_db:
+            conn = pricedb.connect(args.history_db)
+            pricedb.add_snapshot(conn, db)
+            conn.close()
+            print(f'Appended prices to \'{args.history_db}\'')
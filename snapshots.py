@@ -0,0 +1,302 @@
+import argparse
+import functools
+import json
+import os
+import re
+import sys
+import threading
+from datetime import datetime, timezone
+
+# backup dir layout, one file per snapshot:
+#   db_<region>_<yymmdd>.json        keyframe, full db as written by scrape_lenovo.py
+#   db_<region>_<yymmdd>.delta.json  delta against the latest keyframe before it
+#
+# every snapshot is rebuilt from at most two files (its keyframe and its delta)
+# a new keyframe is written every KEYFRAME_INTERVAL snapshots to keep deltas small
+#
+#delta = {
+#    'metadata': db['metadata'],
+#    'keyframe': 'db_<region>_<yymmdd>.json',
+#    'changes':  db['changes'],
+#    'keys':     db['keys'],
+#    'brands':   db['brands'],
+#    'added':    [[brand, prod, part_db], ...],    # parts not in keyframe
+#    'changed':  [[brand, prod, part number, { 'spec': new value, ... }, ['removed spec', ...]], ...],
+#    'removed':  [[brand, prod, part number], ...], # keyframe parts not in snapshot
+#}
+KEYFRAME_INTERVAL = 10
+FILENAME_RE = re.compile(r'db_(.+)_(\d{6})(\.delta)?\.json$')
+
+# returns { 'region', 'date', 'ts', 'delta' } or None if filename is not a snapshot
+# ts is the snapshot day (UTC midnight), unlike mtime it survives rewrites by convert_dir()
+def parse_filename(filename):
+    m = FILENAME_RE.match(filename)
+    if not m: return None
+    try:
+        ts = datetime.strptime(m.group(2), '%y%m%d').replace(tzinfo=timezone.utc).timestamp()
+    except ValueError: return None
+    return {'region': m.group(1), 'date': m.group(2), 'ts': ts, 'delta': bool(m.group(3))}
+
+def entry_key(entry):
+    return (entry['region'], entry['date'], entry['mtime'])
+
+# returns [{ 'region', 'date', 'ts', 'delta', 'path', 'mtime', 'size' }, ...] in snapshot order
+def list_snapshots(backup_dir, region=None):
+    entries = []
+    for f in os.scandir(backup_dir):
+        entry = parse_filename(f.name)
+        if entry and (region is None or entry['region'] == region):
+            stat = f.stat()
+            entry['path']  = f.path
+            entry['mtime'] = stat.st_mtime
+            entry['size']  = stat.st_size
+            entries.append(entry)
+    return sorted(entries, key=entry_key)
+
+# in-memory list_snapshots() of backup dir, kept current with update_catalog() on file events
+# so readers do no directory I/O
+#catalog = {
+#    'dir':     backup dir,
+#    'regions': { region: { path: entry, ... }, ... }, # entries as in list_snapshots()
+#    'summary': { region: summary, ... },              # cache of get_catalog_summary(), dropped on update
+#    'lock':    threading.Lock(),
+#}
+def new_catalog(backup_dir):
+    catalog = {
+        'dir':     backup_dir,
+        'regions': {},
+        'summary': {},
+        'lock':    threading.Lock(),
+    }
+    for entry in list_snapshots(backup_dir):
+        catalog['regions'].setdefault(entry['region'], {})[entry['path']] = entry
+    return catalog
+
+# adds, replaces or removes snapshot file at path depending on whether it still exists
+# returns False if path is not a snapshot file
+def update_catalog(catalog, path):
+    entry = parse_filename(os.path.basename(path))
+    if not entry: return False
+    region = entry['region']
+    try:
+        stat = os.stat(path)
+        entry['path']  = path
+        entry['mtime'] = stat.st_mtime
+        entry['size']  = stat.st_size
+    except FileNotFoundError:
+        entry = None
+    with catalog['lock']:
+        # entries are replaced, not modified, so readers can use them without lock
+        entries = dict(catalog['regions'].get(region, {}))
+        if entry: entries[path] = entry
+        else:     entries.pop(path, None)
+        catalog['regions'][region] = entries
+        catalog['summary'].pop(region, None)
+    return True
+
+# returns list_snapshots(catalog['dir'], region) without directory I/O
+def catalog_snapshots(catalog, region=None):
+    with catalog['lock']:
+        regions = [catalog['regions'].get(region, {})] if region else list(catalog['regions'].values())
+    return sorted([entry for entries in regions for entry in entries.values()], key=entry_key)
+
+#summary = {
+#    'count':     number of snapshots,
+#    'keyframes': number of keyframes,
+#    'first':     day timestamp of first snapshot or None,
+#    'last':      day timestamp of last snapshot or None,
+#    'bytes':     size of all snapshot files,
+#}
+def get_catalog_summary(catalog, region):
+    with catalog['lock']:
+        summary = catalog['summary'].get(region)
+        entries = catalog['regions'].get(region, {})
+    if summary is None:
+        tss = [e['ts'] for e in entries.values()]
+        summary = {
+            'count':     len(entries),
+            'keyframes': sum(1 for e in entries.values() if not e['delta']),
+            'first':     min(tss, default=None),
+            'last':      max(tss, default=None),
+            'bytes':     sum(e['size'] for e in entries.values()),
+        }
+        with catalog['lock']:
+            # skip if entries changed while summarizing
+            if catalog['regions'].get(region, {}) is entries: catalog['summary'][region] = summary
+    return summary
+
+def snapshot_filename(db, delta=False):
+    date = datetime.fromtimestamp(db['metadata']['timestamp']).strftime('%y%m%d')
+    return f'db_{db["metadata"]["short region"]}_{date}{".delta" if delta else ""}.json'
+
+# { (brand, prod, part number): part_db, ... }
+def part_map(db):
+    parts = {}
+    for brand, prods in db['data'].items():
+        for prod, prod_parts in prods.items():
+            for part in prod_parts:
+                parts[(brand, prod, part['part number'])] = part
+    return parts
+
+# returns ({ 'spec': new value, ... }, ['removed spec', ...]) of part compared to old part
+def part_diff(old, new):
+    return {k: v for k, v in new.items() if k not in old or old[k] != v}, [k for k in old if k not in new]
+
+def patch_part(old, spec_values, removed):
+    part = dict(old)
+    part.update(spec_values)
+    for spec in removed: del part[spec]
+    return part
+
+def make_delta(keyframe, db, keyframe_filename):
+    old = part_map(keyframe)
+    new = part_map(db)
+    return {
+        'metadata': db['metadata'],
+        'keyframe': keyframe_filename,
+        'changes':  db['changes'],
+        'keys':     db['keys'],
+        'brands':   db['brands'],
+        'added':    [[k[0], k[1], part] for k, part in new.items() if k not in old],
+        'changed':  [[*k, *part_diff(old[k], part)] for k, part in new.items() if k in old and old[k] != part],
+        'removed':  [list(k) for k in old if k not in new],
+    }
+
+# returns db rebuilt from keyframe and delta, keyframe is not modified
+# parts keep keyframe order, added parts are appended to their product line
+def apply_delta(keyframe, delta):
+    data = {brand: {prod: list(parts) for prod, parts in prods.items()} for brand, prods in keyframe['data'].items()}
+
+    removed = {tuple(k) for k in delta['removed']}
+    changed = {(brand, prod, pn): (spec_values, removed_specs) for brand, prod, pn, spec_values, removed_specs in delta['changed']}
+    for brand, prods in data.items():
+        for prod, parts in prods.items():
+            parts[:] = [
+                patch_part(p, *changed[(brand, prod, p['part number'])]) if (brand, prod, p['part number']) in changed else p
+                for p in parts if (brand, prod, p['part number']) not in removed
+            ]
+    for brand, prod, part in delta['added']:
+        data.setdefault(brand, {}).setdefault(prod, []).append(part)
+    # drop product lines and brands emptied by removals
+    data = {brand: {prod: parts for prod, parts in prods.items() if parts} for brand, prods in data.items()}
+    data = {brand: prods for brand, prods in data.items() if prods}
+
+    db = {
+        'metadata': delta['metadata'],
+        'changes':  delta['changes'],
+        'prices':   {},
+        'keys':     delta['keys'],
+        'brands':   delta['brands'],
+        'data':     data,
+    }
+    # flatten prices like scrape_lenovo.py
+    for brand, prods in data.items():
+        for prod, parts in prods.items():
+            for part in parts:
+                db['prices'][part['part number']] = part['num_specs']['price']
+    return db
+
+# parsed keyframes shared by deltas, keyed by mtime to notice rewritten files
+@functools.lru_cache(maxsize=4)
+def load_keyframe(path, mtime):
+    with open(path, 'r') as f:
+        return json.loads(f.read())
+
+def get_keyframe(path):
+    return load_keyframe(path, os.stat(path).st_mtime)
+
+# returns full db of keyframe or delta file (any db json is read as keyframe)
+def load_snapshot(path):
+    with open(path, 'r') as f:
+        js = json.loads(f.read())
+    if 'keyframe' not in js: return js
+    keyframe = get_keyframe(os.path.join(os.path.dirname(path), js['keyframe']))
+    return apply_delta(keyframe, js)
+
+# returns [(timestamp, part_db or None), ...] of part number in region's snapshots
+# deltas are read without rebuilding their snapshot
+def part_timeline(backup_dir, region, pn):
+    pn = pn.strip().lower()
+    timeline = []
+    for entry in list_snapshots(backup_dir, region):
+        if entry['delta']:
+            with open(entry['path'], 'r') as f:
+                delta = json.loads(f.read())
+            part = None
+            parts = [p for b, pr, p in delta['added'] if p['part number'].strip().lower() == pn]
+            if parts:
+                part = parts[0]
+            else:
+                removed = {(b, pr, p.strip().lower()) for b, pr, p in delta['removed']}
+                changed = {(b, pr, p.strip().lower()): (v, r) for b, pr, p, v, r in delta['changed']}
+                keyframe = get_keyframe(os.path.join(backup_dir, delta['keyframe']))
+                for (brand, prod, part_num), p in part_map(keyframe).items():
+                    key = (brand, prod, pn)
+                    if part_num.strip().lower() == pn and key not in removed:
+                        part = patch_part(p, *changed[key]) if key in changed else p
+                        break
+            timeline.append((delta['metadata']['timestamp'], part))
+        else:
+            db = get_keyframe(entry['path'])
+            part = None
+            for (brand, prod, part_num), p in part_map(db).items():
+                if part_num.strip().lower() == pn:
+                    part = p
+                    break
+            timeline.append((db['metadata']['timestamp'], part))
+    return timeline
+
+# writes js to path through a temp file, a failed write never replaces or truncates an existing file
+def write_json(path, js):
+    tmp = f'{path}.tmp'
+    try:
+        with open(tmp, 'w') as f: json.dump(js, f)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+
+# writes db to backup dir as keyframe or delta, replacing an existing snapshot of the same day
+# the existing snapshot is only removed once the new one is in place
+# returns path of written file
+def write_snapshot(backup_dir, db, keyframe_interval=KEYFRAME_INTERVAL):
+    region = db['metadata']['short region']
+
+    # deltas written since latest keyframe before snapshot
+    date = parse_filename(snapshot_filename(db))['date']
+    entries = [e for e in list_snapshots(backup_dir, region) if e['date'] < date]
+    keyframes = [i for i, e in enumerate(entries) if not e['delta']]
+    if not keyframes or len(entries)-keyframes[-1] >= keyframe_interval:
+        path = f'{backup_dir}/{snapshot_filename(db)}'
+        write_json(path, db)
+    else:
+        keyframe_entry = entries[keyframes[-1]]
+        delta = make_delta(get_keyframe(keyframe_entry['path']), db, os.path.basename(keyframe_entry['path']))
+        path = f'{backup_dir}/{snapshot_filename(db, delta=True)}'
+        write_json(path, delta)
+
+    for delta in [False, True]:
+        old_path = f'{backup_dir}/{snapshot_filename(db, delta)}'
+        if old_path != path and os.path.exists(old_path): os.remove(old_path)
+    return path
+
+# rewrites full backups of backup dir as keyframes and deltas
+def convert_dir(backup_dir, keyframe_interval=KEYFRAME_INTERVAL, verbose=False):
+    for entry in list_snapshots(backup_dir):
+        if entry['delta']: continue
+        with open(entry['path'], 'r') as f:
+            db = json.loads(f.read())
+        # full backup is replaced or removed by write_snapshot() only after its keyframe or delta is written
+        load_keyframe.cache_clear()
+        path = write_snapshot(backup_dir, db, keyframe_interval)
+        if verbose: print(f'Wrote \'{entry["path"]}\' as \'{path}\'')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert full backup dbs to keyframes and deltas')
+    parser.add_argument('backup_dir')
+    parser.add_argument('-k', '--keyframe_interval', type=int, default=KEYFRAME_INTERVAL, help='snapshots per keyframe')
+    parser.add_argument('-q', '--quiet', action='store_true')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.backup_dir): sys.exit(f'\'{args.backup_dir}\' is not a directory')
+    convert_dir(args.backup_dir, args.keyframe_interval, verbose=not args.quiet)